@@ -1,4 +1,6 @@
+import io
 import os
+import sys
 import json
 import mimetypes
 import time
@@ -6,23 +8,67 @@ import logging
 import threading
 import uuid
 import shutil
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, session
+import sqlite3
+import itertools
+import queue
+import base64
+import struct
+import subprocess
+import errno
+import gzip
+import random
+import marshal
+import pstats
+import cProfile
+import urllib.parse
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, session, g
+from flask.json.provider import DefaultJSONProvider
 from PIL import Image
 from werkzeug.utils import secure_filename
 from functools import lru_cache
 
+try:
+    import pyinstrument  # Optional, used for profiles requested with 'pyinstrument'
+except ImportError:
+    pyinstrument = None
+
+try:
+    import pillow_heif  # Optional, decodes HEIC photos that carry no JPEG preview
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pillow_heif = None
+
+try:
+    import orjson  # Optional, faster JSON serialization
+except ImportError:
+    orjson = None
+
+try:
+    import brotli  # Optional, brotli response compression
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key'
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 app.config['CACHE_TIMEOUT'] = 60  # Cache timeout in seconds
+app.config['SCAN_WORKERS'] = 2  # Maximum number of scans running at once (one per volume)
+app.config['SCAN_TASK_TTL'] = 600  # Seconds to keep finished scan task records
+app.config['WALK_CONCURRENCY'] = 8  # Default concurrent scandir calls per walked root
 
 # Directory scan progress tracking
 scan_tasks = {}
 # Structure: {
 #   'task_id': {
 #     'directory': '/path/to/dir',
-#     'status': 'scanning|complete|error',
+#     'kind': 'scan|index',
+#     'priority': 0 (interactive) - 10 (background),
+#     'status': 'queued|scanning|complete|error|cancelled',
 #     'progress': 0-100,
 #     'files_found': 0,
 #     'images_found': 0,
@@ -43,8 +89,28 @@ logger = logging.getLogger('speedy')
 # Store the directories being monitored
 MONITORED_DIRS_FILE = os.path.join(app.config['UPLOAD_FOLDER'], 'monitored_dirs.json')
 
+# Library-wide photo index (SQLite) used by the /query endpoint
+INDEX_DB_FILE = os.path.join(app.config['UPLOAD_FOLDER'], 'photo_index.db')
+app.config['QUERY_PAGE_SIZE'] = 100  # Default number of results per query page
+app.config['QUERY_MAX_PAGE_SIZE'] = 1000  # Upper bound for the 'limit' query parameter
+app.config['INDEX_REFRESH_INTERVAL'] = 3600  # Seconds between background re-indexes (0 disables)
+app.config['TREE_REFRESH_INTERVAL'] = 60  # Seconds before a shown sidebar node is re-listed in the background
+app.config['TREE_MAX_DEPTH'] = 5  # Upper bound for the 'depth' parameter of /get_directory_structure
+app.config['RENDITION_CACHE_BYTES'] = 64 * 1024 * 1024  # In-memory preview cache size
+app.config['RENDITION_MAX_AGE'] = 3600  # Seconds before unused previews and unsaved rotations are dropped
+app.config['RENDITION_PREVIEW_SIZE'] = 2048  # Longest side of rotation previews in pixels
+app.config['RENDITION_THUMBNAIL_SIZE'] = 400  # Longest side of grid thumbnails of RAW/HEIC/video files
+app.config['MEDIA_PREVIEW_WORKERS'] = 2  # Concurrent preview extractions (ffmpeg runs, RAW decodes)
+app.config['PROFILE_BUFFER_SIZE'] = 50  # Number of request profiles kept for /debug/profiles
+app.config['PROFILE_SAMPLE_RATE'] = 0.0  # Loaded from the 'profile_sample_rate' setting
+app.config['COMPRESS_MIN_SIZE'] = 1024  # JSON responses smaller than this are sent uncompressed
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+app.config['TRASH_PURGE_INTERVAL'] = 3600  # Seconds between retention purges of the trash
+app.config['FFMPEG_PATH'] = shutil.which('ffmpeg')  # Video poster frames are skipped without ffmpeg
+app.config['VIDEO_POSTER_TIMEOUT'] = 20  # Seconds
+
 # Cache storage
-directory_structure_cache = {}
 directory_images_cache = {}
 
 # Cache invalidation timestamps
@@ -56,7 +122,10 @@ SETTINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settin
 # Default settings
 DEFAULT_SETTINGS = {
     'trash_folder': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trash'),
-    'favorites_folder': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'favorites')
+    'favorites_folder': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'favorites'),
+    'trash_retention_days': 30,  # 0 keeps trashed images until the size limit is reached
+    'trash_max_size_mb': 0,  # 0 means no size limit
+    'profile_sample_rate': 0.0
 }
 
 def get_settings():
@@ -147,63 +216,94 @@ def save_monitored_directories(directories):
     global last_directory_change
     last_directory_change = time.time()
     logger.info(f"Updated last_directory_change timestamp to {last_directory_change}")
-    directory_structure_cache.clear()
     directory_images_cache.clear()
-    logger.info("Cleared directory and image caches")
+    logger.info("Cleared image cache")
 
 def is_image(file_path):
-    """Check if a file is an image based on its MIME type."""
-    mime_type, _ = mimetypes.guess_type(file_path)
-    return mime_type and mime_type.startswith('image/')
+    """Check if a file is a plain image the browser can show (and PIL can rotate)."""
+    return media_kind(file_path) == 'image'
+
+def is_media(file_path):
+    """Check if a file is any listed media type: images, RAW, HEIC or video."""
+    return get_media_type(file_path) is not None
+
+def media_fields(path):
+    """The kind, url and thumbnail_url fields the API returns for a file"""
+    kind = media_kind(path)
+    # The viewer shows previews of RAW/HEIC files; videos play from the file itself
+    url = f"/rendition?path={path}" if kind in ('raw', 'heic') else f"/image?path={path}"
+    return {
+        'kind': kind,
+        'url': url,
+        'thumbnail_url': url if kind == 'image' else f"/rendition?path={path}&size=thumb"
+    }
 
-def get_directory_structure(path, lazy_load=True):
-    """Return the directory structure as a nested dictionary with caching.
-    When lazy_load is True, only scan the current directory level and not subdirectories.
+class DirectoryListing:
+    """Compact cached listing of the images in one directory.
+    
+    Instead of one dict per image, the listing keeps the directory path once
+    and stores names, timestamps and sizes in parallel columns. The per-image
+    dicts sent to the client (path, url, kind, date_str, ...) are only built at
+    serialization time by to_dicts().
     """
-    # Check if we have a valid cached version
-    cache_key = f"structure:{path}"
-    if cache_key in directory_structure_cache:
-        cache_time, cached_data = directory_structure_cache[cache_key]
-        # Check if cache is still valid
-        if time.time() - cache_time < app.config['CACHE_TIMEOUT'] and cache_time > last_directory_change:
-            print(f"Using cached directory structure for {path}")
-            return cached_data
+    __slots__ = ('directory', 'names', 'created', 'modified', 'sizes')
     
-    # If not cached or cache invalid, compute the structure
-    result = {'name': os.path.basename(path), 'path': path, 'type': 'directory', 'children': []}
-    
-    try:
-        for item in os.listdir(path):
-            item_path = os.path.join(path, item)
-            if os.path.isdir(item_path):
-                # If lazy loading, just add a placeholder for the directory
-                if lazy_load:
-                    result['children'].append({
-                        'name': item,
-                        'path': item_path,
-                        'type': 'directory',
-                        'children': [],  # Empty children array as placeholder
-                        'lazy': True     # Mark as lazy loaded
-                    })
-                else:
-                    # If not lazy loading, recursively get the structure
-                    result['children'].append(get_directory_structure(item_path, lazy_load))
-            elif os.path.isfile(item_path) and is_image(item_path):
-                result['children'].append({
-                    'name': item,
-                    'path': item_path,
-                    'type': 'image'
-                })
-    except (PermissionError, FileNotFoundError):
-        # Handle permission errors or if directory doesn't exist anymore
-        pass
+    def __init__(self, directory):
+        self.directory = sys.intern(directory)
+        self.names = []
+        self.created = array('d')
+        self.modified = array('d')
+        self.sizes = array('q')
     
-    # Cache the result
-    directory_structure_cache[cache_key] = (time.time(), result)
-    return result
+    def __len__(self):
+        return len(self.names)
+    
+    def append(self, name, created=0, modified=0, size=0):
+        self.names.append(name)
+        self.created.append(created)
+        self.modified.append(modified)
+        self.sizes.append(size)
+    
+    def to_compact(self):
+        """Column-oriented form of the listing: the directory once, then one array per field.
+        
+        Files other than plain images are listed by kind in 'media', as
+        indexes into the columns (e.g. {'video': [3, 17]}).
+        """
+        media = {}
+        for i, name in enumerate(self.names):
+            kind = media_kind(name)
+            if kind != 'image':
+                media.setdefault(kind, []).append(i)
+        return {
+            'format': 'compact',
+            'directory': self.directory,
+            'sep': os.sep,
+            'names': self.names,
+            'created': self.created.tolist(),
+            'modified': self.modified.tolist(),
+            'sizes': self.sizes.tolist(),
+            'media': media
+        }
+    
+    def to_dicts(self):
+        """Expand the listing into the per-image dicts used by the API"""
+        images = []
+        for name, created, modified, size in zip(self.names, self.created, self.modified, self.sizes):
+            path = os.path.join(self.directory, name)
+            images.append({
+                'name': name,
+                'path': path,
+                **media_fields(path),
+                'created': created,
+                'modified': modified,
+                'size': size,
+                'date_str': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created)) if created else 'Unknown date'
+            })
+        return images
 
 def get_directory_images(directory_path):
-    """Get all images in a directory with caching."""
+    """Get all images in a directory as a DirectoryListing, with caching."""
     # Check if we have a valid cached version
     cache_key = f"images:{directory_path}"
     if cache_key in directory_images_cache:
@@ -214,40 +314,22 @@ def get_directory_images(directory_path):
             return cached_data
     
     # If not cached or cache invalid, get the images
-    images = []
+    images = DirectoryListing(directory_path)
     try:
         for item in os.listdir(directory_path):
             item_path = os.path.join(directory_path, item)
-            if os.path.isfile(item_path) and is_image(item_path):
+            if os.path.isfile(item_path) and is_media(item_path) and not is_pending_trash(item_path):
                 # Get file creation time and modification time
                 try:
                     # Get file stats
                     stat_info = os.stat(item_path)
                     # Use the earlier of creation time or modification time as "date created"
                     # On some systems, creation time might not be available
-                    created_time = stat_info.st_ctime
-                    modified_time = stat_info.st_mtime
-                    
-                    # Just return the file path, name, and date information
-                    images.append({
-                        'name': item,
-                        'path': item_path,
-                        'url': f"/image?path={item_path}",
-                        'created': created_time,
-                        'modified': modified_time,
-                        'date_str': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created_time))
-                    })
+                    images.append(item, stat_info.st_ctime, stat_info.st_mtime, stat_info.st_size)
                 except Exception as e:
                     logger.error(f"Error getting file info for {item_path}: {e}")
                     # Add the image without date information if there's an error
-                    images.append({
-                        'name': item,
-                        'path': item_path,
-                        'url': f"/image?path={item_path}",
-                        'created': 0,
-                        'modified': 0,
-                        'date_str': 'Unknown date'
-                    })
+                    images.append(item)
     except (PermissionError, FileNotFoundError) as e:
         # Handle permission errors or if directory doesn't exist anymore
         logger.error(f"Error accessing directory {directory_path}: {e}")
@@ -258,6 +340,1007 @@ def get_directory_images(directory_path):
     directory_images_cache[cache_key] = (time.time(), images)
     return images
 
+# ---------------------------------------------------------------------------
+# Parallel directory walking
+#
+# os.walk lists one directory at a time, so on network volumes the walk is
+# bound by per-directory round trips. parallel_walk keeps a pool of threads
+# issuing scandir calls for every directory discovered so far.
+# ---------------------------------------------------------------------------
+
+def get_walk_concurrency(root):
+    """Number of concurrent scandir calls to use when walking a root.
+    
+    Per-root overrides live in the 'walk_concurrency' setting, a mapping of
+    directory -> thread count; the longest matching directory wins.
+    """
+    overrides = get_settings().get('walk_concurrency') or {}
+    best = None
+    for directory, concurrency in overrides.items():
+        directory = directory.rstrip(os.sep)
+        if root == directory or root.startswith(directory + os.sep):
+            if best is None or len(directory) > len(best[0]):
+                best = (directory, concurrency)
+    if best is not None:
+        return max(1, int(best[1]))
+    return app.config['WALK_CONCURRENCY']
+
+def parallel_walk(root, concurrency=None, ordered=False, file_filter=None, stat_files=False,
+                  progress=None, cancel_event=None, onerror=None):
+    """Walk a directory tree with concurrent scandir calls.
+    
+    Yields (dirpath, dirnames, filenames, file_stats) for every directory,
+    like os.walk. file_stats is a list of os.stat_result (None where stat
+    failed) matching filenames when stat_files is True, otherwise None; the
+    stat calls are made on the pool threads too.
+    
+    - concurrency: pool size, defaults to get_walk_concurrency(root)
+    - ordered: yield in the same order as a top-down os.walk with sorted
+      names; otherwise directories are yielded as soon as they are listed
+    - file_filter: callable(path) -> bool deciding which files to report
+    - progress: callable(dirpath, directories_done, files_found), called from
+      the consuming thread after each directory
+    - cancel_event: threading.Event that stops the walk early when set; no
+      more directories are yielded after that, so every yielded directory
+      was actually listed
+    
+    - onerror: callable(dirpath, exception), called from the consuming thread
+      for each directory that could not be listed, just before it is yielded
+    
+    Symlinked directories are reported in dirnames but not descended into.
+    Unreadable directories are logged and reported as empty.
+    """
+    if concurrency is None:
+        concurrency = get_walk_concurrency(root)
+    stop_event = threading.Event()
+    results = queue.Queue()
+    futures = {}
+    futures_lock = threading.Lock()
+    submitted = [0]
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='walk')
+    
+    def stopped():
+        return stop_event.is_set() or (cancel_event is not None and cancel_event.is_set())
+    
+    def submit(path):
+        with futures_lock:
+            submitted[0] += 1
+            futures[path] = executor.submit(scan, path)
+    
+    def scan(path):
+        dirnames, filenames, file_stats, descend = [], [], [], []
+        error = None
+        try:
+            if not stopped():
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            dirnames.append(entry.name)
+                            if not entry.is_symlink():
+                                descend.append(entry.name)
+                            continue
+                        if file_filter is not None and not file_filter(entry.path):
+                            continue
+                        filenames.append(entry.name)
+                        if stat_files:
+                            try:
+                                file_stats.append(entry.stat())
+                            except OSError as e:
+                                logger.error(f"Error getting file info for {entry.path}: {e}")
+                                file_stats.append(None)
+        except OSError as e:
+            logger.warning(f"Error listing directory {path}: {e}")
+            error = e
+        except Exception as e:
+            # Never lose a directory's result, or the consumer would wait forever
+            logger.error(f"Error walking directory {path}: {e}")
+            error = e
+        
+        if ordered:
+            dirnames.sort()
+            descend.sort()
+            if stat_files:
+                pairs = sorted(zip(filenames, file_stats), key=lambda pair: pair[0])
+                filenames = [name for name, _ in pairs]
+                file_stats = [stat_info for _, stat_info in pairs]
+            else:
+                filenames.sort()
+        
+        # Queue subdirectories right away so the pool never runs dry
+        if stopped():
+            descend = []
+        for name in descend:
+            submit(os.path.join(path, name))
+        
+        result = (path, dirnames, filenames, file_stats if stat_files else None, descend, error)
+        if not ordered:
+            results.put(result)
+        return result
+    
+    def unordered_results():
+        # A directory queues its children before reporting itself, so once every
+        # submitted directory has been consumed there is nothing left in flight
+        consumed = 0
+        while True:
+            with futures_lock:
+                if consumed == submitted[0]:
+                    return
+            result = results.get()
+            consumed += 1
+            with futures_lock:
+                del futures[result[0]]
+            yield result
+    
+    def ordered_results():
+        # Pre-order traversal over the futures, children visited in sorted order
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            with futures_lock:
+                future = futures.pop(path)
+            result = future.result()
+            stack.extend(os.path.join(path, name) for name in reversed(result[4]))
+            yield result
+    
+    directories_done = 0
+    files_found = 0
+    try:
+        submit(root)
+        for dirpath, dirnames, filenames, file_stats, _, error in (ordered_results() if ordered else unordered_results()):
+            if cancel_event is not None and cancel_event.is_set():
+                # Directories queued after this point skipped their scandir
+                return
+            if error is not None and onerror is not None:
+                onerror(dirpath, error)
+            directories_done += 1
+            files_found += len(filenames)
+            if progress is not None:
+                progress(dirpath, directories_done, files_found)
+            yield dirpath, dirnames, filenames, file_stats
+    finally:
+        # Also reached when the caller stops iterating early
+        stop_event.set()
+        with futures_lock:
+            for future in futures.values():
+                future.cancel()
+        executor.shutdown(wait=False)
+
+# ---------------------------------------------------------------------------
+# Photo index
+#
+# A SQLite database holding one row per image across all monitored directories.
+# It is filled in the background by walking the monitored directories and is
+# then queried by /query without touching the filesystem. Secondary indexes
+# cover date, size, extension, directory and favorite flag; filename search
+# goes through an FTS5 trigram table when the SQLite build supports it.
+# ---------------------------------------------------------------------------
+
+_index_local = threading.local()
+index_write_lock = threading.Lock()
+index_fts_enabled = False
+
+# Sortable columns accepted by /query
+QUERY_SORT_COLUMNS = {
+    'created': 'created',
+    'modified': 'modified',
+    'size': 'size',
+    'name': 'name'
+}
+
+def get_index_db():
+    """Return the calling thread's connection to the photo index"""
+    conn = getattr(_index_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(INDEX_DB_FILE), exist_ok=True)
+        conn = sqlite3.connect(INDEX_DB_FILE, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _index_local.conn = conn
+    return conn
+
+def init_index_db():
+    """Create the photo index tables and secondary indexes if needed"""
+    global index_fts_enabled
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                ext TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL DEFAULT 0,
+                modified REAL NOT NULL DEFAULT 0,
+                favorite INTEGER NOT NULL DEFAULT 0,
+                indexed_at REAL NOT NULL DEFAULT 0
+            )
+        ''')
+        # The trailing id column keeps cursor pagination on these indexes
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_created ON images (created, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_modified ON images (modified, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_size ON images (size, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_name ON images (name, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_ext ON images (ext, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_directory ON images (directory, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_favorite ON images (favorite, id)')
+        
+        # Directory tree snapshot for the sidebar; counts are NULL until the node is listed
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tree_nodes (
+                path TEXT PRIMARY KEY,
+                parent TEXT NOT NULL,
+                name TEXT NOT NULL,
+                image_count INTEGER,
+                subdir_count INTEGER,
+                refreshed_at REAL NOT NULL DEFAULT 0,
+                seen_at REAL NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tree_nodes_parent ON tree_nodes (parent, name)')
+        
+        # Trashed images (status: pending, moving, trashed, restoring or failed)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS trash (
+                id INTEGER PRIMARY KEY,
+                original_path TEXT NOT NULL,
+                trash_path TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                deleted_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_trash_original_path ON trash (original_path)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_trash_deleted_at ON trash (deleted_at)')
+        
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+                    name, content='images', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images BEGIN
+                    INSERT INTO images_fts (rowid, name) VALUES (new.id, new.name);
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images BEGIN
+                    INSERT INTO images_fts (images_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS images_fts_update AFTER UPDATE OF name ON images BEGIN
+                    INSERT INTO images_fts (images_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO images_fts (rowid, name) VALUES (new.id, new.name);
+                END
+            ''')
+            index_fts_enabled = True
+        except sqlite3.OperationalError as e:
+            # Older SQLite builds lack the trigram tokenizer; fall back to LIKE scans
+            logger.warning(f"Trigram filename search unavailable, using LIKE instead: {e}")
+            index_fts_enabled = False
+
+def directory_prefix_clause(column, directory):
+    """Build a range condition matching a directory and everything below it.
+    
+    Uses a range instead of LIKE so that the directory index can be used:
+    every path below '/a/b' sorts between '/a/b/' and '/a/b0' ('0' follows '/').
+    """
+    directory = directory.rstrip(os.sep) or os.sep
+    if directory == os.sep:
+        return '1', []
+    return (f"({column} = ? OR ({column} >= ? AND {column} < ?))",
+            [directory, directory + os.sep, directory + chr(ord(os.sep) + 1)])
+
+# ---------------------------------------------------------------------------
+# Directory tree snapshot
+#
+# The sidebar is served from a persisted snapshot of every monitored tree
+# (the tree_nodes table in the photo index), with per-directory image and
+# subdirectory counts. Full snapshots are written by the index walk; single
+# nodes are re-listed in the background when they are shown and have gone
+# stale, so expanding a node never waits on the filesystem once it is known.
+# ---------------------------------------------------------------------------
+
+tree_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='tree')
+tree_refresh_pending = set()
+tree_refresh_lock = threading.Lock()
+
+def upsert_tree_nodes(nodes, children):
+    """Write snapshot nodes and make sure their children have (placeholder) rows.
+    
+    nodes: (path, parent, name, image_count, subdir_count, refreshed_at) tuples
+    children: (path, parent, name, seen_at) tuples; existing counts are kept
+    """
+    if not nodes and not children:
+        return
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.executemany('''
+            INSERT INTO tree_nodes (path, parent, name, image_count, subdir_count, refreshed_at, seen_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                image_count = excluded.image_count,
+                subdir_count = excluded.subdir_count,
+                refreshed_at = excluded.refreshed_at,
+                seen_at = excluded.seen_at
+        ''', [node + (node[5],) for node in nodes])
+        conn.executemany('''
+            INSERT INTO tree_nodes (path, parent, name, seen_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET seen_at = MAX(seen_at, excluded.seen_at)
+        ''', children)
+
+def remove_tree_nodes(directory):
+    """Drop a directory and everything below it from the snapshot"""
+    clause, params = directory_prefix_clause('path', directory)
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.execute(f"DELETE FROM tree_nodes WHERE {clause}", params)
+
+def refresh_tree_node(path):
+    """Re-list one directory and update its snapshot node and direct children.
+    
+    Returns False if the directory no longer exists.
+    """
+    image_count = 0
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                        continue
+                except OSError:
+                    continue
+                if is_media(entry.name):
+                    image_count += 1
+    except (FileNotFoundError, NotADirectoryError):
+        remove_tree_nodes(path)
+        return False
+    except OSError as e:
+        # Keep what the snapshot already knows (transient network errors); a
+        # directory that was never listed (e.g. no permission) shows as empty
+        logger.warning(f"Error listing directory {path}: {e}")
+        if get_index_db().execute('SELECT 1 FROM tree_nodes WHERE path = ? AND image_count IS NOT NULL',
+                                  (path,)).fetchone():
+            return True
+    
+    now = time.time()
+    upsert_tree_nodes(
+        [(path, os.path.dirname(path), os.path.basename(path), image_count, len(subdirs), now)],
+        [(os.path.join(path, name), path, name, now) for name in subdirs]
+    )
+    
+    # Subdirectories that disappeared since the last listing
+    current = set(subdirs)
+    conn = get_index_db()
+    for row in conn.execute('SELECT path, name FROM tree_nodes WHERE parent = ?', (path,)).fetchall():
+        if row['name'] not in current:
+            remove_tree_nodes(row['path'])
+    return True
+
+def _refresh_tree_node_job(path):
+    try:
+        refresh_tree_node(path)
+    except Exception as e:
+        logger.error(f"Error refreshing directory tree node {path}: {e}")
+    finally:
+        with tree_refresh_lock:
+            tree_refresh_pending.discard(path)
+
+def schedule_tree_refresh(paths):
+    """Re-list directories in the background, skipping ones already queued"""
+    with tree_refresh_lock:
+        for path in paths:
+            if path not in tree_refresh_pending:
+                tree_refresh_pending.add(path)
+                tree_refresh_executor.submit(_refresh_tree_node_job, path)
+
+def tree_node_to_dict(row):
+    return {
+        'name': row['name'],
+        'path': row['path'],
+        'type': 'directory',
+        'image_count': row['image_count'],
+        'subdir_count': row['subdir_count'],
+        'children': [],
+        'lazy': True
+    }
+
+def get_tree_snapshot(path, depth=1):
+    """Return a directory and `depth` levels of subdirectories from the snapshot.
+    
+    Directories at the depth boundary are marked lazy. Nodes that are shown
+    and older than TREE_REFRESH_INTERVAL are queued for a background refresh.
+    Returns None if the directory is not in the snapshot.
+    """
+    conn = get_index_db()
+    columns = 'path, parent, name, image_count, subdir_count, refreshed_at'
+    row = conn.execute(f"SELECT {columns} FROM tree_nodes WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        return None
+    
+    cutoff = time.time() - app.config['TREE_REFRESH_INTERVAL']
+    stale = [path] if row['refreshed_at'] < cutoff else []
+    result = tree_node_to_dict(row)
+    level = {path: result}
+    for current_depth in range(depth):
+        if not level:
+            break
+        rows = conn.execute(
+            f"SELECT {columns} FROM tree_nodes WHERE parent IN ({', '.join('?' * len(level))}) ORDER BY name",
+            list(level)
+        ).fetchall()
+        for node in level.values():
+            node['lazy'] = False
+        next_level = {}
+        for row in rows:
+            child = tree_node_to_dict(row)
+            level[row['parent']]['children'].append(child)
+            next_level[row['path']] = child
+            # Only the first level is visible right away
+            if current_depth == 0 and row['refreshed_at'] < cutoff:
+                stale.append(row['path'])
+        level = next_level
+    
+    if stale:
+        schedule_tree_refresh(stale)
+    return result
+
+def index_image_row(path, stat_info, favorites, now):
+    """Build the index row tuple for an image"""
+    name = os.path.basename(path)
+    return (
+        path,
+        os.path.dirname(path),
+        name,
+        os.path.splitext(name)[1].lower().lstrip('.'),
+        stat_info.st_size,
+        stat_info.st_ctime,
+        stat_info.st_mtime,
+        1 if path in favorites else 0,
+        now
+    )
+
+def upsert_index_rows(rows):
+    """Insert or update a batch of index rows"""
+    if not rows:
+        return
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.executemany('''
+            INSERT INTO images (path, directory, name, ext, size, created, modified, favorite, indexed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                size = excluded.size,
+                created = excluded.created,
+                modified = excluded.modified,
+                favorite = excluded.favorite,
+                indexed_at = excluded.indexed_at
+        ''', rows)
+
+def index_directory_tree(root, task=None, cancel_event=None):
+    """Walk a monitored directory and bring its photo index rows and tree snapshot up to date.
+    
+    Progress is reported into the optional scan task record. Returns False if
+    the walk was cancelled, in which case stale rows are left alone.
+    """
+    logger.info(f"Indexing {root}")
+    start_time = time.time()
+    favorites = set(get_favorites())
+    batch = []
+    tree_nodes = []
+    tree_children = []
+    indexed = 0
+    failed_directories = []
+    
+    def report_progress(dir_root, directories_done, images_found):
+        if task is not None:
+            task['current_path'] = dir_root
+            task['files_found'] = images_found
+            task['images_found'] = images_found
+    
+    for dir_root, dirs, files, file_stats in parallel_walk(root, file_filter=is_media, stat_files=True,
+                                                           progress=report_progress, cancel_event=cancel_event,
+                                                           onerror=lambda path, error: failed_directories.append(path)):
+        if failed_directories and failed_directories[-1] == dir_root:
+            # Listing failed (e.g. a network hiccup): keep its snapshot node as it was
+            continue
+        tree_nodes.append((dir_root, os.path.dirname(dir_root), os.path.basename(dir_root),
+                           len(files), len(dirs), start_time))
+        tree_children.extend((os.path.join(dir_root, name), dir_root, name, start_time) for name in dirs)
+        if len(tree_nodes) >= 500:
+            upsert_tree_nodes(tree_nodes, tree_children)
+            tree_nodes, tree_children = [], []
+        for file, stat_info in zip(files, file_stats):
+            if stat_info is None:
+                continue
+            batch.append(index_image_row(os.path.join(dir_root, file), stat_info, favorites, start_time))
+            if len(batch) >= 500:
+                upsert_index_rows(batch)
+                indexed += len(batch)
+                batch = []
+    if cancel_event is not None and cancel_event.is_set():
+        # Leave the unflushed batches out; the next index run writes them
+        logger.info(f"Indexing of {root} cancelled after {indexed} images")
+        return False
+    
+    upsert_index_rows(batch)
+    upsert_tree_nodes(tree_nodes, tree_children)
+    indexed += len(batch)
+    
+    # Anything under this root that was not seen during the walk is gone, except
+    # below directories that could not be listed this time
+    def unseen_clause(column):
+        clause, params = directory_prefix_clause(column, root)
+        for directory in failed_directories:
+            failed_clause, failed_params = directory_prefix_clause(column, directory)
+            clause += f" AND NOT ({failed_clause})"
+            params += failed_params
+        return clause, params
+    
+    if len(failed_directories) > 100:
+        logger.warning(f"{len(failed_directories)} directories in {root} could not be listed; "
+                       f"skipping stale entry removal")
+        return True
+    
+    conn = get_index_db()
+    with index_write_lock, conn:
+        clause, params = unseen_clause('directory')
+        removed = conn.execute(f"DELETE FROM images WHERE {clause} AND indexed_at < ?",
+                               params + [start_time]).rowcount
+        clause, params = unseen_clause('path')
+        conn.execute(f"DELETE FROM tree_nodes WHERE {clause} AND seen_at < ?", params + [start_time])
+    if failed_directories:
+        logger.warning(f"Kept existing index entries below {len(failed_directories)} unreadable "
+                       f"directories in {root}")
+    
+    logger.info(f"Indexed {indexed} images in {root} ({removed} stale entries removed) "
+                f"in {time.time() - start_time:.1f}s")
+    return True
+
+def index_directory_task(task_id, directory, cancel_event):
+    """Scan scheduler job that re-indexes one monitored directory"""
+    task = scan_tasks[task_id]
+    if index_directory_tree(directory, task, cancel_event):
+        task['status'] = 'complete'
+        task['progress'] = 100
+        task['end_time'] = time.time()
+
+def schedule_index_refresh(directories, priority=None):
+    """Queue background re-indexing of the given directories"""
+    if priority is None:
+        priority = SCAN_PRIORITY_BACKGROUND
+    for directory in directories:
+        if os.path.isdir(directory):
+            scan_scheduler.submit('index', directory, index_directory_task, priority)
+
+def index_refresh_loop():
+    """Re-index the monitored directories every INDEX_REFRESH_INTERVAL seconds,
+    picking up photos added, changed or removed outside the app"""
+    while not index_refresh_stop.wait(app.config['INDEX_REFRESH_INTERVAL']):
+        try:
+            schedule_index_refresh(get_monitored_directories())
+        except Exception as e:
+            logger.error(f"Error scheduling periodic index refresh: {e}")
+
+index_refresh_stop = threading.Event()
+
+def start_index_refresh_timer():
+    if app.config['INDEX_REFRESH_INTERVAL'] > 0:
+        threading.Thread(target=index_refresh_loop, name='index-refresh', daemon=True).start()
+
+def remove_from_index(directory):
+    """Drop all index rows for a directory tree"""
+    clause, params = directory_prefix_clause('directory', directory)
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.execute(f"DELETE FROM images WHERE {clause}", params)
+    remove_tree_nodes(directory)
+
+def remove_image_from_index(image_path):
+    """Drop a single image from the index"""
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.execute('DELETE FROM images WHERE path = ?', (image_path,))
+
+def update_image_in_index(image_path):
+    """Refresh a single image's row after it was modified on disk"""
+    try:
+        stat_info = os.stat(image_path)
+    except OSError as e:
+        logger.error(f"Error getting file info for {image_path}: {e}")
+        return
+    upsert_index_rows([index_image_row(image_path, stat_info, set(get_favorites()), time.time())])
+
+def sync_index_favorites(favorited_images):
+    """Mirror the favorites list into the index's favorite flags"""
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.execute('UPDATE images SET favorite = 0 WHERE favorite = 1')
+        conn.executemany('UPDATE images SET favorite = 1 WHERE path = ?',
+                         [(path,) for path in favorited_images])
+
+def parse_query_date(value, end_of_day=False):
+    """Parse a YYYY-MM-DD (or YYYY) query parameter into a timestamp"""
+    if len(value) == 4 and value.isdigit():
+        year = int(value)
+        moment = datetime(year + 1, 1, 1) if end_of_day else datetime(year, 1, 1)
+        return time.mktime(moment.timetuple())
+    moment = datetime.strptime(value, '%Y-%m-%d')
+    timestamp = time.mktime(moment.timetuple())
+    return timestamp + 86400 if end_of_day else timestamp
+
+def encode_query_cursor(sort_value, row_id):
+    """Encode the position after the last returned row as an opaque cursor"""
+    raw = json.dumps([sort_value, row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_query_cursor(cursor):
+    """Decode a cursor produced by encode_query_cursor"""
+    raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+    sort_value, row_id = json.loads(raw)
+    return sort_value, int(row_id)
+
+def glob_to_like(pattern, escape=True):
+    """Turn a '*'/'?' filename pattern into a case-insensitive LIKE pattern.
+    
+    With escape=False, literal '%' and '_' are left as wildcards, which yields a
+    superset match that the trigram index can serve (it cannot serve LIKE ... ESCAPE).
+    """
+    if escape:
+        pattern = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return pattern.replace('*', '%').replace('?', '_')
+
+def query_index(args):
+    """Run a library-wide search against the photo index.
+    
+    Supported filters: q (filename substring, or pattern with * and ?), year,
+    date_from / date_to (YYYY-MM-DD, inclusive), min_size / max_size (bytes),
+    ext (comma separated), directory (prefix), favorites (true/false).
+    Results are ordered by 'sort' (created, modified, size, name) in 'order'
+    (asc/desc) and paginated with an opaque 'cursor'.
+    """
+    conditions = []
+    params = []
+    
+    q = (args.get('q') or '').strip()
+    if q:
+        # Plain text is a substring search; '*' and '?' make it an anchored pattern
+        if '*' not in q and '?' not in q:
+            q = f"*{q}*"
+        if index_fts_enabled:
+            # LIKE against a trigram FTS table is served from the trigram index
+            conditions.append("id IN (SELECT rowid FROM images_fts WHERE name LIKE ?)")
+            params.append(glob_to_like(q, escape=False))
+        conditions.append("name LIKE ? ESCAPE '\\'")
+        params.append(glob_to_like(q))
+    
+    year = args.get('year')
+    if year:
+        conditions.append('created >= ? AND created < ?')
+        params.extend([parse_query_date(year), parse_query_date(year, end_of_day=True)])
+    if args.get('date_from'):
+        conditions.append('created >= ?')
+        params.append(parse_query_date(args['date_from']))
+    if args.get('date_to'):
+        conditions.append('created < ?')
+        params.append(parse_query_date(args['date_to'], end_of_day=True))
+    
+    if args.get('min_size'):
+        conditions.append('size >= ?')
+        params.append(int(args['min_size']))
+    if args.get('max_size'):
+        conditions.append('size <= ?')
+        params.append(int(args['max_size']))
+    
+    if args.get('ext'):
+        extensions = [e.strip().lower().lstrip('.') for e in args['ext'].split(',') if e.strip()]
+        if extensions:
+            conditions.append(f"ext IN ({', '.join('?' * len(extensions))})")
+            params.extend(extensions)
+    
+    if args.get('directory'):
+        clause, clause_params = directory_prefix_clause('directory', args['directory'])
+        conditions.append(clause)
+        params.extend(clause_params)
+    
+    favorites = args.get('favorites')
+    if favorites is not None and favorites != '':
+        conditions.append('favorite = ?')
+        params.append(1 if favorites.lower() in ('1', 'true', 'yes') else 0)
+    
+    sort_column = QUERY_SORT_COLUMNS.get(args.get('sort', 'created'))
+    if not sort_column:
+        raise ValueError(f"Unsupported sort column: {args.get('sort')}")
+    descending = args.get('order', 'desc').lower() != 'asc'
+    comparison = '<' if descending else '>'
+    direction = 'DESC' if descending else 'ASC'
+    
+    if args.get('cursor'):
+        sort_value, row_id = decode_query_cursor(args['cursor'])
+        conditions.append(f"({sort_column}, id) {comparison} (?, ?)")
+        params.extend([sort_value, row_id])
+    
+    limit = int(args.get('limit', app.config['QUERY_PAGE_SIZE']))
+    limit = max(1, min(limit, app.config['QUERY_MAX_PAGE_SIZE']))
+    
+    where = ' AND '.join(conditions) if conditions else '1'
+    sql = (f"SELECT id, path, name, size, created, modified, favorite FROM images "
+           f"WHERE {where} ORDER BY {sort_column} {direction}, id {direction} LIMIT ?")
+    rows = get_index_db().execute(sql, params + [limit + 1]).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_query_cursor(last[sort_column], last['id'])
+    
+    images = [{
+        'name': row['name'],
+        'path': row['path'],
+        **media_fields(row['path']),
+        'size': row['size'],
+        'created': row['created'],
+        'modified': row['modified'],
+        'date_str': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['created'])),
+        'favorite': bool(row['favorite'])
+    } for row in rows]
+    
+    return images, next_cursor
+
+# ---------------------------------------------------------------------------
+# Request profiling
+#
+# Opt-in per request with an 'X-Speedy-Profile' header or a '_profile' query
+# parameter ('1' / 'cprofile', or 'pyinstrument' when it is installed), or for
+# a random share of requests via the 'profile_sample_rate' setting. Profiles
+# are kept in a ring buffer and can be browsed at /debug/profiles. Requests
+# that are not profiled only pay for a header and argument lookup.
+# ---------------------------------------------------------------------------
+
+profiles = deque(maxlen=app.config['PROFILE_BUFFER_SIZE'])
+profiles_lock = threading.Lock()
+
+def load_profiling_settings(settings=None):
+    """Cache the profiling sample rate so requests don't read settings.json"""
+    settings = settings or get_settings()
+    try:
+        app.config['PROFILE_SAMPLE_RATE'] = max(0.0, min(1.0, float(settings.get('profile_sample_rate') or 0)))
+    except (TypeError, ValueError):
+        app.config['PROFILE_SAMPLE_RATE'] = 0.0
+
+def requested_profiler():
+    """Return (profiler name, trigger) for the current request, or (None, None)"""
+    flag = request.headers.get('X-Speedy-Profile')
+    trigger = 'header'
+    if flag is None:
+        flag = request.args.get('_profile')
+        trigger = 'query'
+    if flag is None:
+        rate = app.config['PROFILE_SAMPLE_RATE']
+        if not rate or random.random() >= rate:
+            return None, None
+        flag, trigger = '1', 'sample'
+    flag = flag.lower()
+    if flag in ('0', 'false', 'no', ''):
+        return None, None
+    if flag == 'pyinstrument' and pyinstrument is not None:
+        return 'pyinstrument', trigger
+    return 'cprofile', trigger
+
+@app.before_request
+def start_request_profile():
+    if request.path.startswith('/debug/') or request.path.startswith('/static/'):
+        return
+    profiler_name, trigger = requested_profiler()
+    if profiler_name is None:
+        return
+    
+    try:
+        if profiler_name == 'pyinstrument':
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+    except (RuntimeError, ValueError) as e:
+        # Only one profiler can be active at a time on some Python versions
+        logger.warning(f"Could not profile {request.path}: {e}")
+        return
+    g.profile = {
+        'profiler_name': profiler_name,
+        'profiler': profiler,
+        'trigger': trigger,
+        'start': time.perf_counter()
+    }
+
+def stop_request_profile(status):
+    """Stop the current request's profiler and store the result; returns its id"""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    
+    profiler = profile['profiler']
+    if profile['profiler_name'] == 'pyinstrument':
+        profiler.stop()
+        result = profiler
+    else:
+        profiler.disable()
+        profiler.create_stats()
+        # The raw stats dict; pstats.Stats(profiler) would empty profiler.stats
+        result = dict(profiler.stats)
+    
+    record = {
+        'id': uuid.uuid4().hex[:12],
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': status,
+        'duration': time.perf_counter() - profile['start'],
+        'timestamp': time.time(),
+        'profiler': profile['profiler_name'],
+        'trigger': profile['trigger'],
+        'result': result
+    }
+    with profiles_lock:
+        profiles.append(record)
+    logger.info(f"Profiled {record['method']} {record['path']} in {record['duration'] * 1000:.1f}ms "
+                f"(profile {record['id']})")
+    return record['id']
+
+@app.after_request
+def finish_request_profile(response):
+    if 'profile' in g:
+        profile_id = stop_request_profile(response.status_code)
+        if profile_id:
+            response.headers['X-Speedy-Profile-Id'] = profile_id
+    return response
+
+@app.teardown_request
+def abort_request_profile(exc):
+    # Requests that raised skip after_request; still record what was captured
+    if 'profile' in g:
+        stop_request_profile(500)
+
+def find_profile(profile_id):
+    with profiles_lock:
+        for record in profiles:
+            if record['id'] == profile_id:
+                return record
+    return None
+
+@app.route('/debug/profiles', methods=['GET'])
+def list_profiles():
+    """List captured request profiles, newest first"""
+    with profiles_lock:
+        records = list(profiles)
+    return jsonify({
+        'sample_rate': app.config['PROFILE_SAMPLE_RATE'],
+        'pyinstrument_available': pyinstrument is not None,
+        'profiles': [{
+            'id': record['id'],
+            'method': record['method'],
+            'path': record['path'],
+            'endpoint': record['endpoint'],
+            'status': record['status'],
+            'duration_ms': round(record['duration'] * 1000, 2),
+            'timestamp': record['timestamp'],
+            'profiler': record['profiler'],
+            'trigger': record['trigger'],
+            'view_url': url_for('view_profile', profile_id=record['id']),
+            'download_url': url_for('download_profile', profile_id=record['id'])
+        } for record in reversed(records)]
+    })
+
+@app.route('/debug/profiles/<profile_id>', methods=['GET'])
+def view_profile(profile_id):
+    """Show a profile: pstats text for cProfile (?sort=&limit=), HTML for pyinstrument"""
+    record = find_profile(profile_id)
+    if record is None:
+        return jsonify({'success': False, 'error': f'Profile not found: {profile_id}'}), 404
+    
+    if record['profiler'] == 'pyinstrument':
+        return record['result'].output_html()
+    
+    sort = request.args.get('sort', 'cumulative')
+    limit = request.args.get('limit', 60, type=int)
+    stream = io.StringIO()
+    stream.write(f"{record['method']} {record['path']} -> {record['status']} "
+                 f"in {record['duration'] * 1000:.1f}ms\n\n")
+    # Work on a copy so that viewing never changes the stored profile
+    stats = pstats.Stats(stream=stream)
+    stats.stats = dict(record['result'])
+    stats.get_top_level_stats()
+    try:
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    except KeyError:
+        return jsonify({'success': False, 'error': f'Unknown sort key: {sort}'}), 400
+    return app.response_class(stream.getvalue(), mimetype='text/plain')
+
+@app.route('/debug/profiles/<profile_id>/download', methods=['GET'])
+def download_profile(profile_id):
+    """Download a profile (.prof for cProfile/snakeviz, .html for pyinstrument)"""
+    record = find_profile(profile_id)
+    if record is None:
+        return jsonify({'success': False, 'error': f'Profile not found: {profile_id}'}), 404
+    
+    if record['profiler'] == 'pyinstrument':
+        data = record['result'].output_html().encode('utf-8')
+        filename, mimetype = f"speedy-{profile_id}.html", 'text/html'
+    else:
+        data = marshal.dumps(record['result'])
+        filename, mimetype = f"speedy-{profile_id}.prof", 'application/octet-stream'
+    return send_file(io.BytesIO(data), mimetype=mimetype, as_attachment=True, download_name=filename)
+
+# ---------------------------------------------------------------------------
+# Response encoding
+#
+# JSON responses are compressed with brotli (when installed) or gzip,
+# depending on the client's Accept-Encoding, and serialized with orjson when
+# it is installed.
+# ---------------------------------------------------------------------------
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes with orjson"""
+    
+    options = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self.options),
+                                        mimetype=self.mimetype)
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+def choose_content_encoding():
+    """Pick the best compression the client accepts, or None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    if (response.mimetype != 'application/json'
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = choose_content_encoding()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    
+    if encoding == 'br':
+        data = brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    else:
+        data = gzip.compress(data, compresslevel=app.config['COMPRESS_GZIP_LEVEL'])
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 @app.route('/')
 def index():
     """Main application page. Only show directory names without scanning contents."""
@@ -299,6 +1382,7 @@ def update_app_settings():
             # Ensure folders exist
             ensure_trash_folder()
             ensure_favorites_folder()
+            load_profiling_settings(current_settings)
             return jsonify({'success': True, 'settings': current_settings})
         else:
             return jsonify({'success': False, 'error': 'Failed to save settings'}), 500
@@ -306,44 +1390,323 @@ def update_app_settings():
         logger.error(f"Error updating settings: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# ---------------------------------------------------------------------------
+# Trash
+#
+# Deleting an image only records it in the trash table of the photo index and
+# queues the move; the image is hidden from listings right away. A single
+# background worker moves the files (a rename on the same volume, a streamed
+# copy when the trash folder is on another one) and purges trashed files
+# past the retention limits. Restores look the original path up in the table.
+# ---------------------------------------------------------------------------
+
+trash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trash')
+trash_lock = threading.Lock()
+trash_pending = {}  # original path -> trash id, for images not moved yet
+trash_last_purge = 0
+
+def trash_row_to_dict(row):
+    return {
+        'id': row['id'],
+        'original_path': row['original_path'],
+        'trash_path': row['trash_path'],
+        'size': row['size'],
+        'deleted_at': row['deleted_at'],
+        'status': row['status'],
+        'error': row['error']
+    }
+
+def is_pending_trash(path):
+    """True if the image is queued for the trash but not moved yet"""
+    return path in trash_pending
+
+def invalidate_directory_listings():
+    global last_directory_change
+    last_directory_change = time.time()
+
+def move_file(src, dst):
+    """Move a file with a rename, or a copy and delete if dst is on another volume.
+    
+    The copy is written next to dst and renamed into place once it is complete
+    and synced, so an interrupted move never leaves a truncated file behind.
+    """
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    
+    partial_path = f"{dst}.partial"
+    try:
+        shutil.copyfile(src, partial_path)
+        shutil.copystat(src, partial_path)
+        with open(partial_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(partial_path, dst)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    try:
+        os.remove(src)
+    except OSError:
+        # Leave a single copy: the source stays where it was
+        os.remove(dst)
+        raise
+
+def enqueue_trash(image_path):
+    """Record an image as deleted and queue its move; returns the trash row"""
+    trash_folder = ensure_trash_folder()
+    if not trash_folder:
+        raise OSError('Failed to create trash folder')
+    
+    try:
+        size = os.path.getsize(image_path)
+    except OSError:
+        size = 0
+    now = time.time()
+    filename = os.path.basename(image_path)
+    
+    conn = get_index_db()
+    with trash_lock:
+        with index_write_lock, conn:
+            cursor = conn.execute('''
+                INSERT INTO trash (original_path, trash_path, size, deleted_at, status)
+                VALUES (?, '', ?, ?, 'pending')
+            ''', (image_path, size, now))
+            trash_id = cursor.lastrowid
+            # Timestamp prefix as before; the id keeps names unique
+            trash_path = os.path.join(trash_folder, f"{int(now)}_{trash_id}_{filename}")
+            conn.execute('UPDATE trash SET trash_path = ? WHERE id = ?', (trash_path, trash_id))
+        trash_pending[image_path] = trash_id
+    
+    # Before queueing, so a failed move's re-index cannot be undone by this
+    remove_image_from_index(image_path)
+    trash_executor.submit(_move_to_trash_job, trash_id)
+    return conn.execute('SELECT * FROM trash WHERE id = ?', (trash_id,)).fetchone()
+
+def set_trash_status(trash_id, status, error=None):
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.execute('UPDATE trash SET status = ?, error = ? WHERE id = ?', (status, error, trash_id))
+
+def _move_to_trash_job(trash_id):
+    conn = get_index_db()
+    with trash_lock:
+        row = conn.execute('SELECT * FROM trash WHERE id = ?', (trash_id,)).fetchone()
+        if row is None or row['status'] not in ('pending', 'moving'):
+            # Restored before it was moved
+            return
+        set_trash_status(trash_id, 'moving')
+    
+    original_path = row['original_path']
+    try:
+        if os.path.exists(original_path) or not os.path.exists(row['trash_path']):
+            move_file(original_path, row['trash_path'])
+        set_trash_status(trash_id, 'trashed')
+        remove_image_from_index(original_path)
+        schedule_tree_refresh([os.path.dirname(original_path)])
+        logger.info(f"Moved {original_path} to trash")
+    except Exception as e:
+        logger.error(f"Error moving {original_path} to trash: {e}")
+        set_trash_status(trash_id, 'failed', str(e))
+        # The image is still in place; let listings and the index show it again
+        update_image_in_index(original_path)
+        invalidate_directory_listings()
+    finally:
+        with trash_lock:
+            if trash_pending.get(original_path) == trash_id:
+                del trash_pending[original_path]
+    
+    # Keep the trash within its size limit as it grows
+    schedule_trash_purge(force=True)
+
+def resume_trash_moves():
+    """Re-queue moves that were still pending when the app last stopped"""
+    conn = get_index_db()
+    rows = conn.execute("SELECT id, original_path FROM trash WHERE status IN ('pending', 'moving') ORDER BY id").fetchall()
+    with trash_lock:
+        for row in rows:
+            trash_pending[row['original_path']] = row['id']
+    for row in rows:
+        trash_executor.submit(_move_to_trash_job, row['id'])
+    if rows:
+        logger.info(f"Resuming {len(rows)} pending trash moves")
+
+def restore_from_trash(trash_id):
+    """Move a trashed image back to its original path.
+    
+    Returns an (error message, HTTP status) tuple, or None on success.
+    """
+    with trash_lock:
+        row = get_index_db().execute('SELECT * FROM trash WHERE id = ?', (trash_id,)).fetchone()
+        if row is None:
+            return 'Item not found in trash', 404
+        original_path = row['original_path']
+        if row['status'] == 'pending':
+            # Not moved yet: dropping the record is enough
+            delete_trash_rows([trash_id])
+            trash_pending.pop(original_path, None)
+            update_image_in_index(original_path)
+            invalidate_directory_listings()
+            return None
+        if row['status'] != 'trashed':
+            return f"Cannot restore an item that is {row['status']}", 409
+        if os.path.exists(original_path):
+            return 'A file already exists at the original path', 409
+        set_trash_status(trash_id, 'restoring')
+    
+    try:
+        os.makedirs(os.path.dirname(original_path), exist_ok=True)
+        move_file(row['trash_path'], original_path)
+    except Exception as e:
+        logger.error(f"Error restoring {original_path} from trash: {e}")
+        set_trash_status(trash_id, 'trashed', str(e))
+        return str(e), 500
+    
+    delete_trash_rows([trash_id])
+    update_image_in_index(original_path)
+    schedule_tree_refresh([os.path.dirname(original_path)])
+    invalidate_directory_listings()
+    return None
+
+def delete_trash_rows(trash_ids):
+    conn = get_index_db()
+    with index_write_lock, conn:
+        conn.executemany('DELETE FROM trash WHERE id = ?', [(trash_id,) for trash_id in trash_ids])
+
+def purge_trash():
+    """Delete trashed files older than the retention period, then the oldest
+    ones until the trash fits its size limit. Returns (files purged, bytes freed)."""
+    global trash_last_purge
+    trash_last_purge = time.time()
+    
+    settings = get_settings()
+    retention_days = float(settings.get('trash_retention_days') or 0)
+    max_bytes = int(float(settings.get('trash_max_size_mb') or 0) * 1024 * 1024)
+    
+    conn = get_index_db()
+    with trash_lock:
+        rows = conn.execute('''
+            SELECT id, trash_path, size, deleted_at, status FROM trash
+            WHERE status IN ('trashed', 'failed') ORDER BY deleted_at DESC, id DESC
+        ''').fetchall()
+        cutoff = time.time() - retention_days * 86400 if retention_days > 0 else None
+        kept_bytes = 0
+        expired = []
+        for row in rows:
+            if cutoff is not None and row['deleted_at'] < cutoff:
+                expired.append(row)
+            elif row['status'] == 'trashed':
+                kept_bytes += row['size']
+                if max_bytes and kept_bytes > max_bytes:
+                    expired.append(row)
+        delete_trash_rows([row['id'] for row in expired])
+    
+    purged = 0
+    freed = 0
+    for row in expired:
+        if row['status'] != 'trashed':
+            continue
+        try:
+            os.remove(row['trash_path'])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not purge {row['trash_path']}: {e}")
+            continue
+        purged += 1
+        freed += row['size']
+    if purged:
+        logger.info(f"Purged {purged} files ({freed} bytes) from trash")
+    return purged, freed
+
+def _purge_trash_job():
+    try:
+        purge_trash()
+    except Exception as e:
+        logger.error(f"Error purging trash: {e}")
+
+def schedule_trash_purge(force=False):
+    """Queue a retention purge if the last one is older than TRASH_PURGE_INTERVAL"""
+    if force or time.time() - trash_last_purge >= app.config['TRASH_PURGE_INTERVAL']:
+        trash_executor.submit(_purge_trash_job)
+
 @app.route('/delete-image', methods=['POST'])
 def delete_image():
-    """Move an image to the trash folder"""
+    """Move an image to the trash folder.
+    
+    The move happens in the background; the image is hidden from listings
+    as soon as it is queued.
+    """
     try:
         image_path = request.json.get('path')
-        if not image_path or not os.path.exists(image_path):
-            return jsonify({'success': False, 'error': 'Image not found'}), 404
         
-        # Get the trash folder path
-        trash_folder = ensure_trash_folder()
-        if not trash_folder:
-            return jsonify({'success': False, 'error': 'Failed to create trash folder'}), 500
-        
-        # Create a destination path in the trash folder
-        filename = os.path.basename(image_path)
-        # Add timestamp to avoid name conflicts
-        timestamp = int(time.time())
-        trash_filename = f"{timestamp}_{filename}"
-        trash_path = os.path.join(trash_folder, trash_filename)
-        
-        # Move the file to trash
-        import shutil
-        shutil.move(image_path, trash_path)
-        
-        # Invalidate cache
-        global last_directory_change
-        last_directory_change = time.time()
+        row = None
+        trash_id = trash_pending.get(image_path)
+        if trash_id is not None:
+            # Already queued, e.g. a repeated click
+            row = get_index_db().execute('SELECT * FROM trash WHERE id = ?', (trash_id,)).fetchone()
+        if row is None:
+            if not image_path or not os.path.exists(image_path):
+                return jsonify({'success': False, 'error': 'Image not found'}), 404
+            row = enqueue_trash(image_path)
+            discard_pending_rotation(image_path)
+            
+            # Invalidate cache
+            invalidate_directory_listings()
         
         return jsonify({
             'success': True, 
             'message': 'Image moved to trash',
             'original_path': image_path,
-            'trash_path': trash_path
+            'trash_path': row['trash_path'],
+            'trash_id': row['id'],
+            'status': row['status']
         })
     except Exception as e:
         logger.error(f"Error deleting image: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/trash', methods=['GET'])
+def list_trash():
+    """List trashed images, newest first"""
+    schedule_trash_purge()
+    rows = get_index_db().execute('SELECT * FROM trash ORDER BY deleted_at DESC, id DESC').fetchall()
+    return jsonify({
+        'items': [trash_row_to_dict(row) for row in rows],
+        'total_size': sum(row['size'] for row in rows if row['status'] == 'trashed')
+    })
+
+@app.route('/trash/restore', methods=['POST'])
+def restore_trash_item():
+    """Move an image back from the trash, by trash id or original path"""
+    data = request.json or {}
+    conn = get_index_db()
+    if data.get('id') is not None:
+        row = conn.execute('SELECT * FROM trash WHERE id = ?', (data['id'],)).fetchone()
+    else:
+        row = conn.execute('SELECT * FROM trash WHERE original_path = ? ORDER BY deleted_at DESC, id DESC LIMIT 1',
+                           (data.get('original_path'),)).fetchone()
+    if row is None:
+        return jsonify({'success': False, 'error': 'Item not found in trash'}), 404
+    
+    error = restore_from_trash(row['id'])
+    if error:
+        message, status = error
+        return jsonify({'success': False, 'error': message}), status
+    return jsonify({'success': True, 'original_path': row['original_path']})
+
+@app.route('/trash/purge', methods=['POST'])
+def purge_trash_now():
+    """Apply the trash retention limits immediately"""
+    try:
+        purged, freed = purge_trash()
+        return jsonify({'success': True, 'purged': purged, 'freed_bytes': freed})
+    except Exception as e:
+        logger.error(f"Error purging trash: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/scan_directory', methods=['POST'])
 def scan_directory():
     """Start a background task to scan a directory and track progress."""
@@ -368,42 +1731,32 @@ def scan_directory():
             'message': f'Path is not a directory: {directory}'
         }), 400
     
-    # Generate a unique task ID
-    task_id = str(uuid.uuid4())
-    
-    # Initialize task status
-    scan_tasks[task_id] = {
-        'directory': directory,
-        'status': 'scanning',
-        'progress': 0,
-        'files_found': 0,
-        'images_found': 0,
-        'current_path': directory,
-        'start_time': time.time(),
-        'end_time': None
-    }
+    # Scans requested from the UI jump ahead of background jobs unless told otherwise
+    if request.form.get('priority') == 'background':
+        priority = SCAN_PRIORITY_BACKGROUND
+    else:
+        priority = SCAN_PRIORITY_INTERACTIVE
     
-    # Start background scan
-    thread = threading.Thread(target=scan_directory_task, args=(task_id, directory))
-    thread.daemon = True
-    thread.start()
+    # Queue the scan; a scan already pending or running for this directory is reused
+    task_id, created = scan_scheduler.submit('scan', directory, scan_directory_task, priority)
     
     return jsonify({
         'status': 'started',
-        'task_id': task_id
+        'task_id': task_id,
+        'coalesced': not created
     })
 
 @app.route('/scan_status/<task_id>', methods=['GET'])
 def scan_status(task_id):
     """Get the status of a directory scan."""
-    if task_id not in scan_tasks:
+    scan_scheduler.expire_finished()
+    task = scan_tasks.get(task_id)
+    if task is None:
         return jsonify({
             'status': 'error',
             'message': f'Task ID not found: {task_id}'
         }), 404
     
-    task = scan_tasks[task_id]
-    
     # Calculate elapsed time
     elapsed = time.time() - task['start_time']
     
@@ -414,7 +1767,9 @@ def scan_status(task_id):
         'images_found': task['images_found'],
         'current_path': task['current_path'],
         'elapsed_time': elapsed,
-        'directory': task['directory']
+        'directory': task['directory'],
+        'kind': task['kind'],
+        'priority': task['priority']
     }
     
     if task['status'] == 'error' and 'error' in task:
@@ -422,6 +1777,21 @@ def scan_status(task_id):
     
     return jsonify(response)
 
+@app.route('/scan_cancel/<task_id>', methods=['POST'])
+def scan_cancel(task_id):
+    """Cancel a queued or running directory scan."""
+    status = scan_scheduler.cancel(task_id)
+    if status is None:
+        return jsonify({
+            'status': 'error',
+            'message': f'Task ID not found or already finished: {task_id}'
+        }), 404
+    
+    return jsonify({
+        'status': status,
+        'task_id': task_id
+    })
+
 @app.route('/add_directory', methods=['POST'])
 def add_directory():
     directory = request.form.get('directory')
@@ -448,11 +1818,11 @@ def add_directory():
         logger.info(f"Adding new directory to monitor: {directory}")
         directories.append(directory)
         save_monitored_directories(directories)
+        schedule_index_refresh([directory])
         # Clear caches when adding a directory
-        cache_size_before = len(directory_structure_cache), len(directory_images_cache)
-        directory_structure_cache.clear()
+        cache_size_before = len(directory_images_cache)
         directory_images_cache.clear()
-        logger.info(f"Cleared caches. Before: {cache_size_before}, After: (0, 0)")
+        logger.info(f"Cleared image cache. Before: {cache_size_before}, After: 0")
     
     return redirect(url_for('index'))
 
@@ -472,11 +1842,11 @@ def remove_directory():
         logger.info(f"Removing directory from monitoring: {directory}")
         directories.remove(directory)
         save_monitored_directories(directories)
+        remove_from_index(directory)
         # Clear caches when removing a directory
-        cache_size_before = len(directory_structure_cache), len(directory_images_cache)
-        directory_structure_cache.clear()
+        cache_size_before = len(directory_images_cache)
         directory_images_cache.clear()
-        logger.info(f"Cleared caches. Before: {cache_size_before}, After: (0, 0)")
+        logger.info(f"Cleared image cache. Before: {cache_size_before}, After: 0")
     else:
         logger.warning(f"Directory not found in monitored list: {directory}")
     
@@ -484,10 +1854,24 @@ def remove_directory():
 
 @app.route('/get_directory_structure', methods=['GET'])
 def get_structure():
-    """Get the structure of a specific directory."""
+    """Get the subdirectories of a directory from the tree snapshot.
+    
+    'depth' (default 1) returns that many levels at once. Directories missing
+    from the snapshot are listed once synchronously and added to it.
+    """
     directory = request.args.get('directory')
+    try:
+        depth = int(request.args.get('depth', 1))
+    except ValueError:
+        depth = 1
+    depth = max(1, min(depth, app.config['TREE_MAX_DEPTH']))
+    
+    directory_structure = get_tree_snapshot(directory, depth) if directory else None
+    if directory_structure is None and directory and os.path.isdir(directory):
+        refresh_tree_node(directory)
+        directory_structure = get_tree_snapshot(directory, depth)
     
-    if not directory or not os.path.exists(directory) or not os.path.isdir(directory):
+    if directory_structure is None:
         return jsonify({
             'name': 'Error',
             'path': directory or '',
@@ -495,95 +1879,808 @@ def get_structure():
             'children': []
         })
     
-    # Get the structure of just this directory, with lazy loading for subdirectories
-    directory_structure = get_directory_structure(directory, lazy_load=True)
-    
     return jsonify(directory_structure)
 
 @app.route('/get_directory_images', methods=['GET'])
 def get_images():
     directory_path = request.args.get('directory')
     
+    compact = request.args.get('format') == 'compact'
+    
     if directory_path and os.path.isdir(directory_path):
         images = get_directory_images(directory_path)
-        return jsonify(images)
+        return jsonify(images.to_compact() if compact else images.to_dicts())
     
-    return jsonify([])
+    return jsonify(DirectoryListing(directory_path or '').to_compact() if compact else [])
+
+@app.route('/query', methods=['GET'])
+def query_images():
+    """Search the photo index across all monitored directories.
+    
+    Never touches the filesystem; see query_index for the supported filters.
+    """
+    try:
+        images, next_cursor = query_index(request.args)
+    except (ValueError, TypeError, sqlite3.OperationalError) as e:
+        logger.warning(f"Invalid query {dict(request.args)}: {e}")
+        return jsonify({'success': False, 'error': f"Invalid query: {e}"}), 400
+    
+    return jsonify({
+        'success': True,
+        'images': images,
+        'count': len(images),
+        'next_cursor': next_cursor
+    })
 
 @app.route('/image')
 def serve_image():
     """Serve an image file directly."""
     path = request.args.get('path')
-    if path and os.path.exists(path) and is_image(path):
+    if path and os.path.exists(path) and is_media(path):
         return send_file(path)
     return '', 404
 
+# ---------------------------------------------------------------------------
+# Renditions
+#
+# Rotations are not written to disk while the user is still deciding. Each
+# image has at most one pending rotation (the composed angle of all rotate
+# clicks); the viewer shows a downscaled preview rendered into an in-memory
+# cache, and the rotation is applied to the original once, on save.
+# ---------------------------------------------------------------------------
+
+class RenditionCache:
+    """In-memory LRU of encoded renditions (previews), bounded by size and age.
+    
+    Entries can be pinned with acquire() while something refers to them (such
+    as a pending rotation). Unpinned entries are evicted first; pinned ones go
+    only when they expire or when the cache is still over its size limit.
+    """
+    
+    def __init__(self, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> [data, mimetype, last_used]
+        self.refcounts = {}
+        self.total_bytes = 0
+    
+    def get(self, key):
+        """Return (data, mimetype) for a cached rendition, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry[2] = time.time()
+            self.entries.move_to_end(key)
+            return entry[0], entry[1]
+    
+    def put(self, key, data, mimetype):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old[0])
+            self.entries[key] = [data, mimetype, time.time()]
+            self.total_bytes += len(data)
+            self._collect()
+    
+    def acquire(self, key):
+        with self.lock:
+            self.refcounts[key] = self.refcounts.get(key, 0) + 1
+    
+    def release(self, key):
+        with self.lock:
+            count = self.refcounts.get(key, 0) - 1
+            if count > 0:
+                self.refcounts[key] = count
+            else:
+                self.refcounts.pop(key, None)
+    
+    def collect(self):
+        with self.lock:
+            self._collect()
+    
+    def discard(self, match):
+        """Drop every entry whose key satisfies match(key), pinned or not"""
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                self._drop(key)
+    
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= len(entry[0])
+    
+    def _collect(self):
+        cutoff = time.time() - self.max_age
+        for key in [key for key, entry in self.entries.items() if entry[2] < cutoff]:
+            self._drop(key)
+        # Least recently used first, unpinned before pinned
+        for pinned in (False, True):
+            if self.total_bytes <= self.max_bytes:
+                break
+            for key in [key for key in self.entries if (key in self.refcounts) == pinned]:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self._drop(key)
+
+rendition_cache = RenditionCache(app.config['RENDITION_CACHE_BYTES'], app.config['RENDITION_MAX_AGE'])
+
+# Pending rotations: image path -> {'rotation': degrees clockwise, 'mtime': ..., 'updated': ...}
+pending_rotations = {}
+pending_rotations_lock = threading.RLock()
+
+# PIL transpose operations for clockwise rotations
+ROTATION_TRANSPOSE = {
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90
+}
+
+def rotation_preview_key(image_path, rotation, mtime):
+    return ('rotation', image_path, rotation, mtime)
+
+def discard_rotation_previews(image_path):
+    """Forget all rotation previews of an image, e.g. once a rotation is saved"""
+    rendition_cache.discard(lambda key: key[0] == 'rotation' and key[1] == image_path)
+
+def render_rotation_preview(image_path, rotation):
+    """Return (data, mimetype) for a downscaled, rotated preview of an image"""
+    mtime = os.stat(image_path).st_mtime
+    key = rotation_preview_key(image_path, rotation, mtime)
+    cached = rendition_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    with Image.open(image_path) as img:
+        img.draft('RGB', (app.config['RENDITION_PREVIEW_SIZE'],) * 2)
+        preview = img.copy()
+    preview.thumbnail((app.config['RENDITION_PREVIEW_SIZE'],) * 2)
+    if rotation in ROTATION_TRANSPOSE:
+        preview = preview.transpose(ROTATION_TRANSPOSE[rotation])
+    
+    data, mimetype = encode_preview(preview)
+    rendition_cache.put(key, data, mimetype)
+    return data, mimetype
+
+def encode_preview(preview):
+    """Encode a preview as PNG if it has transparency, JPEG otherwise"""
+    buffer = io.BytesIO()
+    if preview.mode in ('RGBA', 'LA', 'P'):
+        preview.save(buffer, format='PNG')
+        mimetype = 'image/png'
+    else:
+        preview.convert('RGB').save(buffer, format='JPEG', quality=85)
+        mimetype = 'image/jpeg'
+    return buffer.getvalue(), mimetype
+
+def expire_pending_rotations():
+    """Forget rotations that were never saved"""
+    cutoff = time.time() - app.config['RENDITION_MAX_AGE']
+    with pending_rotations_lock:
+        for image_path in [path for path, pending in pending_rotations.items() if pending['updated'] < cutoff]:
+            discard_pending_rotation(image_path)
+
+def set_pending_rotation(image_path, rotation):
+    """Record the composed rotation for an image, moving the preview pin along with it"""
+    mtime = os.stat(image_path).st_mtime
+    with pending_rotations_lock:
+        discard_pending_rotation(image_path)
+        if rotation:
+            pending_rotations[image_path] = {'rotation': rotation, 'mtime': mtime, 'updated': time.time()}
+            rendition_cache.acquire(rotation_preview_key(image_path, rotation, mtime))
+
+def discard_pending_rotation(image_path):
+    """Drop an image's pending rotation; returns the discarded angle (0 if none)"""
+    with pending_rotations_lock:
+        pending = pending_rotations.pop(image_path, None)
+        if pending is None:
+            return 0
+        rendition_cache.release(rotation_preview_key(image_path, pending['rotation'], pending['mtime']))
+        return pending['rotation']
+
+def apply_rotation(image_path, rotation):
+    """Rotate the original image file in place (written atomically)"""
+    directory, filename = os.path.split(image_path)
+    temp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex}.tmp")
+    with Image.open(image_path) as img:
+        image_format = img.format
+        rotated = img.transpose(ROTATION_TRANSPOSE[rotation])
+    try:
+        rotated.save(temp_path, format=image_format)
+        # Permissions only: the rotated file must get a new mtime
+        shutil.copymode(image_path, temp_path)
+        os.replace(temp_path, image_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def cleanup_legacy_temp_folder():
+    """Remove rotation files left in temp/ by earlier versions"""
+    temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp')
+    if not os.path.isdir(temp_dir):
+        return
+    for filename in os.listdir(temp_dir):
+        try:
+            os.remove(os.path.join(temp_dir, filename))
+        except OSError as e:
+            logger.warning(f"Could not remove temporary file {filename}: {e}")
+    try:
+        os.rmdir(temp_dir)
+    except OSError:
+        pass
+
+# ---------------------------------------------------------------------------
+# Media types
+#
+# Every listed file belongs to a registered MediaType, looked up by
+# extension. Plain images are served as they are. Other types provide a
+# preview image instead: the JPEG preview embedded in RAW and HEIC files
+# (found by parsing the container, without decoding the raw data), or a
+# poster frame for videos from the registered poster extractors. Previews
+# are downscaled and kept in the rendition cache, like rotation previews.
+# ---------------------------------------------------------------------------
+
+class MediaType:
+    """A kind of file Speedy lists; the base class covers plain images"""
+    
+    kind = 'image'
+    extensions = ()
+    
+    def open_preview(self, path):
+        """Return (PIL image, EXIF orientation) to show instead of the file itself.
+        
+        The image may be returned unloaded so that downscaling can use draft
+        mode. Returns (None, 1) when there is no preview.
+        """
+        return None, 1
+
+class RawMediaType(MediaType):
+    """Camera RAW files, shown through their embedded JPEG preview"""
+    
+    kind = 'raw'
+    extensions = ('.cr2', '.nef', '.arw', '.orf', '.dng')
+    
+    def open_preview(self, path):
+        with open(path, 'rb') as f:
+            previews, orientation = find_tiff_previews(f)
+            data = read_best_jpeg(f, previews)
+        if data is None:
+            return None, 1
+        return Image.open(io.BytesIO(data)), orientation
+
+class HeicMediaType(MediaType):
+    """HEIC/HEIF photos, shown through an embedded JPEG (or decoded with pillow_heif)"""
+    
+    kind = 'heic'
+    extensions = ('.heic', '.heif')
+    
+    def open_preview(self, path):
+        with open(path, 'rb') as f:
+            previews, orientation = find_heif_previews(f)
+            data = read_best_jpeg(f, previews)
+        if data is not None:
+            return Image.open(io.BytesIO(data)), orientation
+        if pillow_heif is not None:
+            # No JPEG inside (the usual case for phone photos); decode the image itself
+            return Image.open(path), 1
+        return None, 1
+
+class VideoMediaType(MediaType):
+    """Videos, played by the browser and shown in the grid by a poster frame"""
+    
+    kind = 'video'
+    extensions = ('.mp4', '.mov', '.m4v', '.3gp', '.avi', '.mkv', '.webm')
+    
+    def open_preview(self, path):
+        for extractor in video_poster_extractors:
+            try:
+                data = extractor(path)
+            except Exception as e:
+                logger.warning(f"Poster extractor {extractor.__name__} failed for {path}: {e}")
+                continue
+            if data:
+                return Image.open(io.BytesIO(data)), 1
+        return None, 1
+
+IMAGE_MEDIA_TYPE = MediaType()
+media_types = {}  # extension -> MediaType
+_media_type_lookup = {}  # memoized get_media_type results by extension
+
+def register_media_type(media_type):
+    """Make a MediaType handle its extensions (replacing earlier registrations)"""
+    for extension in media_type.extensions:
+        media_types[extension.lower()] = media_type
+    _media_type_lookup.clear()
+
+def get_media_type(file_path):
+    """Return the MediaType for a file, or None if Speedy does not list it"""
+    extension = os.path.splitext(file_path)[1].lower()
+    try:
+        return _media_type_lookup[extension]
+    except KeyError:
+        pass
+    media_type = media_types.get(extension)
+    if media_type is None:
+        mime_type, _ = mimetypes.guess_type(f"file{extension}")
+        if mime_type and mime_type.startswith('image/'):
+            media_type = IMAGE_MEDIA_TYPE
+    _media_type_lookup[extension] = media_type
+    return media_type
+
+def media_kind(file_path):
+    media_type = get_media_type(file_path)
+    return media_type.kind if media_type is not None else None
+
+for _media_type in (RawMediaType(), HeicMediaType(), VideoMediaType()):
+    register_media_type(_media_type)
+
+# Callables taking a video path and returning encoded image bytes (or None),
+# tried in order until one produces a poster frame
+video_poster_extractors = []
+
+def register_video_poster_extractor(extractor, first=False):
+    if first:
+        video_poster_extractors.insert(0, extractor)
+    else:
+        video_poster_extractors.append(extractor)
+
+def ffmpeg_poster_frame(path):
+    """Grab a frame one second in (or the first frame of short clips) with ffmpeg"""
+    for position in ('1', '0'):
+        result = subprocess.run(
+            [app.config['FFMPEG_PATH'], '-v', 'error', '-ss', position, '-i', path,
+             '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'mjpeg', '-'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=app.config['VIDEO_POSTER_TIMEOUT']
+        )
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+    return None
+
+if app.config['FFMPEG_PATH']:
+    register_video_poster_extractor(ffmpeg_poster_frame)
+
+# struct formats of the integer TIFF field types (SHORT, LONG, IFD)
+TIFF_INT_FORMATS = {3: 'H', 4: 'I', 13: 'I'}
+
+# EXIF orientation -> PIL transpose that displays the image upright
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90
+}
+
+def read_tiff_ifd(f, base, offset, endian):
+    """Read one IFD; returns ({tag: (type, count, value field)}, next IFD offset)"""
+    f.seek(base + offset)
+    data = f.read(2)
+    if len(data) < 2:
+        return {}, 0
+    (count,) = struct.unpack(endian + 'H', data)
+    data = f.read(12 * count + 4)
+    if len(data) < 12 * count:
+        return {}, 0
+    entries = {}
+    for i in range(count):
+        tag, field_type, value_count, value = struct.unpack(endian + 'HHI4s', data[i * 12:i * 12 + 12])
+        entries[tag] = (field_type, value_count, value)
+    next_offset = struct.unpack(endian + 'I', data[-4:])[0] if len(data) == 12 * count + 4 else 0
+    return entries, next_offset
+
+def tiff_ints(f, base, endian, entry):
+    """Integer values of a SHORT/LONG/IFD field, or [] for other types"""
+    field_type, count, value = entry
+    fmt = TIFF_INT_FORMATS.get(field_type)
+    if fmt is None or not 0 < count <= 1024:
+        return []
+    size = struct.calcsize(fmt) * count
+    if size <= 4:
+        data = value[:size]
+    else:
+        f.seek(base + struct.unpack(endian + 'I', value)[0])
+        data = f.read(size)
+        if len(data) < size:
+            return []
+    return list(struct.unpack(endian + fmt * count, data))
+
+def olympus_makernote_previews(f, base, endian, offset):
+    """Preview locations from an Olympus maker note at offset (relative to base)"""
+    f.seek(base + offset)
+    header = f.read(12)
+    if header.startswith(b'OLYMPUS\0'):
+        # Newer maker notes have their own byte order, and offsets relative to the note
+        note_base = base + offset
+        note_endian = '<' if header[8:10] == b'II' else '>'
+        entries, _ = read_tiff_ifd(f, note_base, 12, note_endian)
+        if 0x2020 not in entries:
+            return []
+        settings_entry = entries[0x2020]
+        if settings_entry[0] in TIFF_INT_FORMATS:
+            settings_offsets = tiff_ints(f, note_base, note_endian, settings_entry)
+        else:
+            settings_offsets = [struct.unpack(note_endian + 'I', settings_entry[2])[0]]
+        if not settings_offsets:
+            return []
+        settings, _ = read_tiff_ifd(f, note_base, settings_offsets[0], note_endian)
+        start, length = (tiff_ints(f, note_base, note_endian, settings[tag]) if tag in settings else []
+                         for tag in (0x0101, 0x0102))
+        return [(offset + start[0], length[0])] if start and length else []
+    if header.startswith(b'OLYMP\0'):
+        entries, _ = read_tiff_ifd(f, base, offset + 8, endian)
+        start, length = (tiff_ints(f, base, endian, entries[tag]) if tag in entries else []
+                         for tag in (0x0088, 0x0089))
+        return [(start[0], length[0])] if start and length else []
+    return []
+
+def find_tiff_previews(f, base=0):
+    """Locate JPEG previews in a TIFF-based file (most RAW formats, EXIF blocks).
+    
+    Returns ([(file offset, length), ...], EXIF orientation). Candidates come
+    from JPEGInterchangeFormat tags and single-strip JPEG-compressed IFDs in
+    every IFD, SubIFD and the EXIF IFD, plus the Olympus maker note preview.
+    Lossless JPEG raw data also matches; read_best_jpeg() filters it out.
+    """
+    f.seek(base)
+    header = f.read(8)
+    if header[:2] == b'II':
+        endian = '<'
+    elif header[:2] == b'MM':
+        endian = '>'
+    else:
+        return [], 1
+    first_ifd = struct.unpack(endian + 'I', header[4:8])[0]
+    
+    previews = []
+    orientation = 1
+    pending = [first_ifd]
+    seen = set()
+    while pending and len(seen) < 64:
+        offset = pending.pop()
+        if not offset or offset in seen:
+            continue
+        seen.add(offset)
+        entries, next_offset = read_tiff_ifd(f, base, offset, endian)
+        pending.append(next_offset)
+        
+        def ints(tag):
+            return tiff_ints(f, base, endian, entries[tag]) if tag in entries else []
+        
+        start, length = ints(0x0201), ints(0x0202)
+        if start and length:
+            previews.append((start[0], length[0]))
+        compression, strips, strip_lengths = ints(0x0103), ints(0x0111), ints(0x0117)
+        if compression and compression[0] in (6, 7) and len(strips) == 1 and len(strip_lengths) == 1:
+            previews.append((strips[0], strip_lengths[0]))
+        if offset == first_ifd and ints(0x0112):
+            orientation = ints(0x0112)[0]
+        pending.extend(ints(0x014A))  # SubIFDs
+        pending.extend(ints(0x8769))  # EXIF IFD
+        if 0x927C in entries and entries[0x927C][1] > 4:
+            makernote_offset = struct.unpack(endian + 'I', entries[0x927C][2])[0]
+            previews.extend(olympus_makernote_previews(f, base, endian, makernote_offset))
+    
+    return [(base + start, length) for start, length in previews if length > 0], orientation
+
+def iter_boxes(f, start, end):
+    """Yield (type, content start, end) for the ISO-BMFF boxes between start and end"""
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            return
+        yield box_type, position + header_size, position + size
+        position += size
+
+def read_box_uint(data, position, size):
+    return int.from_bytes(data[position:position + size], 'big') if size else 0, position + size
+
+def heif_item_locations(data):
+    """Parse an iloc box body; returns {item id: [(offset, length), ...]} for file-stored items"""
+    version = data[0]
+    offset_size, length_size = data[4] >> 4, data[4] & 0x0F
+    base_offset_size, index_size = data[5] >> 4, (data[5] & 0x0F if version in (1, 2) else 0)
+    position = 6
+    item_count, position = read_box_uint(data, position, 2 if version < 2 else 4)
+    locations = {}
+    for _ in range(item_count):
+        item_id, position = read_box_uint(data, position, 2 if version < 2 else 4)
+        construction_method = 0
+        if version in (1, 2):
+            construction_method, position = read_box_uint(data, position, 2)
+            construction_method &= 0x0F
+        position += 2  # data_reference_index
+        base_offset, position = read_box_uint(data, position, base_offset_size)
+        extent_count, position = read_box_uint(data, position, 2)
+        extents = []
+        for _ in range(extent_count):
+            position += index_size
+            extent_offset, position = read_box_uint(data, position, offset_size)
+            extent_length, position = read_box_uint(data, position, length_size)
+            extents.append((base_offset + extent_offset, extent_length))
+        if construction_method == 0:
+            locations[item_id] = extents
+    return locations
+
+def heif_item_types(data):
+    """Parse an iinf box body; returns {item id: item type}"""
+    version = data[0]
+    position = 4 + (2 if version == 0 else 4)
+    types = {}
+    buffer = io.BytesIO(data)
+    for box_type, start, end in iter_boxes(buffer, position, len(data)):
+        if box_type != b'infe' or data[start] < 2:
+            continue
+        id_size = 2 if data[start] == 2 else 4
+        item_id, position = read_box_uint(data, start + 4, id_size)
+        types[item_id] = data[position + 2:position + 6]
+    return types
+
+def find_heif_previews(f):
+    """Locate JPEG images in a HEIF file: JPEG-coded items and EXIF thumbnails.
+    
+    Returns ([(file offset, length), ...], EXIF orientation).
+    """
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    meta = next(((start, end) for box_type, start, end in iter_boxes(f, 0, file_size) if box_type == b'meta'), None)
+    if meta is None:
+        return [], 1
+    
+    types = {}
+    locations = {}
+    for box_type, start, end in iter_boxes(f, meta[0] + 4, meta[1]):
+        if box_type in (b'iinf', b'iloc'):
+            f.seek(start)
+            data = f.read(end - start)
+            if box_type == b'iinf':
+                types = heif_item_types(data)
+            else:
+                locations = heif_item_locations(data)
+    
+    previews = []
+    orientation = 1
+    for item_id, item_type in types.items():
+        extents = locations.get(item_id)
+        if not extents or len(extents) != 1:
+            continue
+        offset, length = extents[0]
+        if item_type == b'jpeg':
+            previews.append((offset, length))
+        elif item_type == b'Exif':
+            f.seek(offset)
+            header_offset = struct.unpack('>I', f.read(4))[0]
+            exif_previews, orientation = find_tiff_previews(f, offset + 4 + header_offset)
+            previews.extend(exif_previews)
+    return previews, orientation
+
+def jpeg_dimensions(f, offset, length):
+    """(width, height) of a baseline or progressive JPEG stored at offset, else None"""
+    f.seek(offset)
+    if f.read(2) != b'\xff\xd8':
+        return None
+    position = offset + 2
+    end = offset + length
+    while position + 4 <= end:
+        f.seek(position)
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        if marker[1] == 0xFF:
+            position += 1
+            continue
+        if marker[1] in (0xC0, 0xC1, 0xC2):
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:5])
+            return width, height
+        if 0xC3 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            # Lossless or arithmetic-coded: raw sensor data, not a preview
+            return None
+        if marker[1] in (0xD9, 0xDA):
+            return None
+        position += 2 + struct.unpack('>H', marker[2:4])[0]
+    return None
+
+def read_best_jpeg(f, previews):
+    """Read the smallest preview covering RENDITION_PREVIEW_SIZE, else the largest one"""
+    target = app.config['RENDITION_PREVIEW_SIZE']
+    candidates = []
+    for offset, length in set(previews):
+        dimensions = jpeg_dimensions(f, offset, length)
+        if dimensions is not None and min(dimensions) > 0:
+            candidates.append((max(dimensions), offset, length))
+    if not candidates:
+        return None
+    large_enough = [candidate for candidate in candidates if candidate[0] >= target]
+    _, offset, length = min(large_enough) if large_enough else max(candidates)
+    f.seek(offset)
+    return f.read(length)
+
+media_preview_executor = ThreadPoolExecutor(max_workers=app.config['MEDIA_PREVIEW_WORKERS'],
+                                            thread_name_prefix='preview')
+media_preview_jobs = {}  # (path, mtime) -> Future of the decoded preview source
+media_preview_jobs_lock = threading.Lock()
+
+def media_preview_key(path, mtime, size):
+    return ('media', path, mtime, size)
+
+def load_media_preview_source(path, media_type):
+    """Extract, decode and orient a file's preview at RENDITION_PREVIEW_SIZE, or None"""
+    image, orientation = media_type.open_preview(path)
+    if image is None:
+        return None
+    with image:
+        image.draft('RGB', (app.config['RENDITION_PREVIEW_SIZE'],) * 2)
+        source = image.copy()
+    source.thumbnail((app.config['RENDITION_PREVIEW_SIZE'],) * 2)
+    if orientation in EXIF_ORIENTATION_TRANSPOSE:
+        source = source.transpose(EXIF_ORIENTATION_TRANSPOSE[orientation])
+    return source
+
+def media_preview_source(path, mtime, media_type):
+    """Decode a file's preview source on the bounded preview pool.
+    
+    Concurrent requests for the same file version wait on one shared job, so
+    a grid of video tiles runs at most MEDIA_PREVIEW_WORKERS extractions.
+    """
+    key = (path, mtime)
+    with media_preview_jobs_lock:
+        future = media_preview_jobs.get(key)
+        if future is None:
+            future = media_preview_executor.submit(load_media_preview_source, path, media_type)
+            media_preview_jobs[key] = future
+            created = True
+        else:
+            created = False
+    if created:
+        future.add_done_callback(lambda done: _forget_media_preview_job(key, done))
+    return future.result()
+
+def _forget_media_preview_job(key, future):
+    with media_preview_jobs_lock:
+        if media_preview_jobs.get(key) is future:
+            del media_preview_jobs[key]
+
+def render_media_preview(path, media_type, size=None):
+    """Return (data, mimetype) for the cached preview of a RAW, HEIC or video file.
+    
+    size is the longest side in pixels (RENDITION_PREVIEW_SIZE by default).
+    Returns None if the file has no usable preview; that is cached too, so
+    poster extraction is not retried on every request.
+    """
+    if size is None:
+        size = app.config['RENDITION_PREVIEW_SIZE']
+    mtime = os.stat(path).st_mtime
+    key = media_preview_key(path, mtime, size)
+    cached = rendition_cache.get(key)
+    if cached is not None:
+        return cached if cached[1] is not None else None
+    
+    source = media_preview_source(path, mtime, media_type)
+    if source is None:
+        rendition_cache.put(key, b'', None)
+        return None
+    preview = source.copy()
+    preview.thumbnail((size, size))
+    
+    data, mimetype = encode_preview(preview)
+    rendition_cache.put(key, data, mimetype)
+    return data, mimetype
+
 @app.route('/rotate-image', methods=['POST'])
 def rotate_image():
-    """Rotate an image and return the temporary path to the rotated version"""
+    """Add a rotation step to an image's pending rotation and return a preview URL"""
     try:
         image_path = request.json.get('path')
         direction = request.json.get('direction', 'clockwise')  # clockwise or counterclockwise
         
         if not image_path or not os.path.exists(image_path):
             return jsonify({'success': False, 'error': 'Image not found'}), 404
+        if not is_image(image_path):
+            return jsonify({'success': False, 'error': 'Only images can be rotated'}), 400
         
-        # Open the image with PIL
-        img = Image.open(image_path)
-        
-        # Rotate the image based on direction
-        if direction == 'clockwise':
-            rotated_img = img.rotate(-90, expand=True)  # -90 degrees for clockwise
-        else:  # counterclockwise
-            rotated_img = img.rotate(90, expand=True)   # 90 degrees for counterclockwise
-        
-        # Create a temporary filename for the rotated image
-        filename = os.path.basename(image_path)
-        temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp')
+        expire_pending_rotations()
+        rendition_cache.collect()
         
-        # Create temp directory if it doesn't exist
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
+        # Compose with the rotation already pending for this image
+        with pending_rotations_lock:
+            rotation = pending_rotations.get(image_path, {}).get('rotation', 0)
+            step = 90 if direction == 'clockwise' else 270
+            rotation = (rotation + step) % 360
+            set_pending_rotation(image_path, rotation)
         
-        # Save to a temporary file with a timestamp to avoid caching issues
-        timestamp = int(time.time())
-        temp_path = os.path.join(temp_dir, f"{timestamp}_{filename}")
-        rotated_img.save(temp_path)
+        preview_url = None
+        if rotation:
+            preview_url = f"/rendition?path={urllib.parse.quote(image_path)}&rotation={rotation}"
         
-        # Return the temporary path and original path
         return jsonify({
             'success': True,
             'message': f'Image rotated {direction}',
             'original_path': image_path,
-            'temp_path': temp_path,
+            'rotation': rotation,
+            'preview_url': preview_url,
             'direction': direction
         })
     except Exception as e:
         logger.error(f"Error rotating image: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/rendition')
+def serve_rendition():
+    """Serve a rotated preview of an image, or the preview of a RAW, HEIC or video
+    file, from the rendition cache"""
+    path = request.args.get('path')
+    try:
+        rotation = int(request.args.get('rotation', 0)) % 360
+    except ValueError:
+        return '', 400
+    media_type = get_media_type(path) if path else None
+    if not path or not os.path.exists(path) or media_type is None or rotation % 90:
+        return '', 404
+    if media_type.kind != 'image' and rotation:
+        return '', 404
+    # Grid tiles ask for size=thumb; everything else gets the full preview
+    size = app.config['RENDITION_THUMBNAIL_SIZE'] if request.args.get('size') == 'thumb' else None
+    
+    try:
+        if media_type.kind == 'image':
+            data, mimetype = render_rotation_preview(path, rotation)
+        else:
+            rendition = render_media_preview(path, media_type, size)
+            if rendition is None:
+                return '', 404
+            data, mimetype = rendition
+    except Exception as e:
+        logger.error(f"Error rendering preview for {path}: {e}")
+        return '', 500
+    return send_file(io.BytesIO(data), mimetype=mimetype, max_age=0)
+
+@app.route('/discard-rotation', methods=['POST'])
+def discard_rotation():
+    """Forget an image's pending rotation without saving it"""
+    image_path = request.json.get('path')
+    rotation = discard_pending_rotation(image_path) if image_path else 0
+    return jsonify({'success': True, 'discarded_rotation': rotation})
+
 @app.route('/save-rotated-image', methods=['POST'])
 def save_rotated_image():
-    """Save a rotated image, replacing the original"""
+    """Apply an image's pending rotation to the original file"""
     try:
-        temp_path = request.json.get('temp_path')
         original_path = request.json.get('original_path')
         
-        if not temp_path or not os.path.exists(temp_path):
-            return jsonify({'success': False, 'error': 'Temporary rotated image not found'}), 404
-        
         if not original_path or not os.path.exists(original_path):
             return jsonify({'success': False, 'error': 'Original image not found'}), 404
+        if not is_image(original_path):
+            return jsonify({'success': False, 'error': 'Only images can be rotated'}), 400
         
         # Check if we have write permission to the original file
         if not os.access(os.path.dirname(original_path), os.W_OK):
             return jsonify({'success': False, 'error': 'No write permission to save the image'}), 403
         
-        # Copy the temporary file to the original location
-        shutil.copy2(temp_path, original_path)
+        rotation = discard_pending_rotation(original_path)
+        if not rotation:
+            # The pending rotation may have expired; fall back to the viewer's angle
+            rotation = int(request.json.get('rotation') or 0) % 360
+        if rotation not in ROTATION_TRANSPOSE:
+            return jsonify({'success': False, 'error': 'No pending rotation for this image'}), 404
         
-        # Remove the temporary file
-        os.remove(temp_path)
+        apply_rotation(original_path, rotation)
+        discard_rotation_previews(original_path)
+        update_image_in_index(original_path)
         
         # Invalidate cache
         global last_directory_change
@@ -592,7 +2689,8 @@ def save_rotated_image():
         return jsonify({
             'success': True,
             'message': 'Rotated image saved',
-            'path': original_path
+            'path': original_path,
+            'rotation': rotation
         })
     except Exception as e:
         logger.error(f"Error saving rotated image: {e}")
@@ -627,7 +2725,8 @@ def migrate_favorites_to_json():
     # Find all image files in the favorites folder
     migrated_favorites = []
     try:
-        for root, _, files in os.walk(favorites_folder):
+        original_filenames = []
+        for root, _, files, _ in parallel_walk(favorites_folder, ordered=True):
             for file in files:
                 # Skip hidden files and non-image files
                 if file.startswith('.') or not is_image(os.path.join(root, file)):
@@ -641,17 +2740,21 @@ def migrate_favorites_to_json():
                     parts = file.split('_', 1)
                     if len(parts) > 1 and parts[0].isdigit():
                         original_filename = parts[1]
-                
-                # Look for this file in monitored directories
-                monitored_dirs = get_monitored_directories()
-                for directory in monitored_dirs:
-                    for dir_root, _, dir_files in os.walk(directory):
-                        for dir_file in dir_files:
-                            if dir_file == original_filename and is_image(os.path.join(dir_root, dir_file)):
-                                original_path = os.path.join(dir_root, dir_file)
-                                migrated_favorites.append(original_path)
-                                logger.info(f"Migrated favorite: {original_path}")
-                                break
+                original_filenames.append(original_filename)
+        
+        if original_filenames:
+            # Walk the monitored directories once, remembering where each image name occurs
+            image_locations = {}
+            for directory in get_monitored_directories():
+                for dir_root, _, dir_files, _ in parallel_walk(directory, ordered=True, file_filter=is_image):
+                    for dir_file in dir_files:
+                        image_locations.setdefault(dir_file, []).append(os.path.join(dir_root, dir_file))
+            
+            # Look for each file in monitored directories
+            for original_filename in original_filenames:
+                for original_path in image_locations.get(original_filename, []):
+                    migrated_favorites.append(original_path)
+                    logger.info(f"Migrated favorite: {original_path}")
         
         # Save the migrated favorites
         if migrated_favorites:
@@ -680,6 +2783,7 @@ def save_favorites(favorited_images):
     try:
         with open(FAVORITES_FILE, 'w') as f:
             json.dump({'favorited_images': favorited_images}, f, indent=2)
+        sync_index_favorites(favorited_images)
         return True
     except Exception as e:
         logger.error(f"Error saving favorites: {e}")
@@ -851,7 +2955,7 @@ def check_favorited():
         logger.error(f"Error checking favorite status: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def scan_directory_task(task_id, directory):
+def scan_directory_task(task_id, directory, cancel_event):
     """Background task to scan a directory and count files and images."""
     task = scan_tasks[task_id]
     total_files = 0
@@ -862,12 +2966,16 @@ def scan_directory_task(task_id, directory):
         logger.info(f"Counting files in {directory}")
         all_files = []
         
-        for root, dirs, files in os.walk(directory):
+        def report_progress(root, directories_done, files_found):
             task['current_path'] = root
+            task['files_found'] = files_found
+        
+        for root, dirs, files, _ in parallel_walk(directory, progress=report_progress, cancel_event=cancel_event):
             all_files.extend([os.path.join(root, f) for f in files])
-            task['files_found'] = len(all_files)
-            # Sleep briefly to avoid hogging CPU
-            time.sleep(0.001)
+        
+        if cancel_event.is_set():
+            logger.info(f"Scan of {directory} cancelled")
+            return
         
         total_files = len(all_files)
         logger.info(f"Found {total_files} files in {directory}")
@@ -875,8 +2983,11 @@ def scan_directory_task(task_id, directory):
         # Now check which ones are images
         if total_files > 0:
             for i, file_path in enumerate(all_files):
+                if cancel_event.is_set():
+                    logger.info(f"Scan of {directory} cancelled")
+                    return
                 task['current_path'] = os.path.dirname(file_path)
-                if is_image(file_path):
+                if is_media(file_path):
                     total_images += 1
                 task['images_found'] = total_images
                 task['progress'] = int((i + 1) / total_files * 100)
@@ -895,19 +3006,206 @@ def scan_directory_task(task_id, directory):
         task['error'] = str(e)
         task['end_time'] = time.time()
 
+# Scan job priorities (lower runs first)
+SCAN_PRIORITY_INTERACTIVE = 0
+SCAN_PRIORITY_BACKGROUND = 10
+
+def volume_key(path):
+    """Identify the volume a path lives on, so jobs on one disk run one at a time"""
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return path
+
+class ScanJob:
+    """A queued or running directory job owned by the ScanScheduler"""
+    
+    def __init__(self, task_id, kind, directory, target, priority, sequence):
+        self.task_id = task_id
+        self.kind = kind
+        self.directory = directory
+        self.target = target
+        self.priority = priority
+        self.sequence = sequence
+        self.volume = volume_key(directory)
+        self.cancel_event = threading.Event()
+    
+    def sort_key(self):
+        return (self.priority, self.sequence)
+
+class ScanScheduler:
+    """Runs directory scans on a bounded pool of worker threads.
+    
+    - At most one job runs per volume, so repeated scans of a big disk don't
+      compete for the same spindle or network share.
+    - A request for a directory that already has a pending or running job of
+      the same kind returns the existing task instead of starting another walk.
+    - Pending jobs are picked by priority, then submission order.
+    - Finished task records are dropped from scan_tasks after SCAN_TASK_TTL.
+    
+    Job targets are called as target(task_id, directory, cancel_event) and
+    should return early once cancel_event is set.
+    """
+    
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.condition = threading.Condition()
+        self.pending = []  # Waiting jobs, sorted by priority then submission order
+        self.running = {}  # task_id -> job
+        self.active = {}  # (kind, directory) -> pending or running job
+        self.busy_volumes = set()
+        self.workers = []
+        self.sequence = itertools.count()
+    
+    def submit(self, kind, directory, target, priority=SCAN_PRIORITY_BACKGROUND):
+        """Queue a job and return (task_id, created)"""
+        directory = os.path.normpath(directory)
+        with self.condition:
+            self.expire_finished()
+            
+            existing = self.active.get((kind, directory))
+            if existing is not None and not existing.cancel_event.is_set():
+                # Coalesce; an interactive request promotes a queued background job
+                if priority < existing.priority and existing.task_id not in self.running:
+                    existing.priority = priority
+                    scan_tasks[existing.task_id]['priority'] = priority
+                    self.pending.sort(key=ScanJob.sort_key)
+                logger.info(f"Reusing {kind} task {existing.task_id} for {directory}")
+                return existing.task_id, False
+            
+            task_id = str(uuid.uuid4())
+            scan_tasks[task_id] = {
+                'directory': directory,
+                'kind': kind,
+                'priority': priority,
+                'status': 'queued',
+                'progress': 0,
+                'files_found': 0,
+                'images_found': 0,
+                'current_path': directory,
+                'start_time': time.time(),
+                'end_time': None
+            }
+            job = ScanJob(task_id, kind, directory, target, priority, next(self.sequence))
+            self.pending.append(job)
+            self.pending.sort(key=ScanJob.sort_key)
+            self.active[(kind, directory)] = job
+            
+            # Workers are started on demand, up to the pool size
+            if len(self.workers) < self.num_workers:
+                worker = threading.Thread(target=self._worker_loop, name=f"scan-worker-{len(self.workers)}")
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            
+            self.condition.notify_all()
+            logger.info(f"Queued {kind} task {task_id} for {directory} (priority {priority})")
+            return task_id, True
+    
+    def cancel(self, task_id):
+        """Cancel a job. Returns 'cancelled', 'cancelling' or None if unknown"""
+        with self.condition:
+            for job in self.pending:
+                if job.task_id == task_id:
+                    self.pending.remove(job)
+                    del self.active[(job.kind, job.directory)]
+                    job.cancel_event.set()
+                    self._mark_cancelled(scan_tasks[task_id])
+                    return 'cancelled'
+            
+            job = self.running.get(task_id)
+            if job is not None:
+                # The worker notices the event and records the cancellation
+                job.cancel_event.set()
+                return 'cancelling'
+        
+        return None
+    
+    def expire_finished(self):
+        """Drop finished task records older than SCAN_TASK_TTL"""
+        cutoff = time.time() - app.config['SCAN_TASK_TTL']
+        with self.condition:
+            expired = [task_id for task_id, task in scan_tasks.items()
+                       if task['end_time'] is not None and task['end_time'] < cutoff]
+            for task_id in expired:
+                del scan_tasks[task_id]
+    
+    def _mark_cancelled(self, task):
+        task['status'] = 'cancelled'
+        task['end_time'] = time.time()
+    
+    def _next_job(self):
+        """Take the first pending job whose volume is idle (caller holds the lock)"""
+        for job in self.pending:
+            if job.volume not in self.busy_volumes:
+                self.pending.remove(job)
+                return job
+        return None
+    
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self._next_job()
+                self.busy_volumes.add(job.volume)
+                self.running[job.task_id] = job
+                task = scan_tasks[job.task_id]
+                task['status'] = 'scanning'
+            
+            try:
+                job.target(job.task_id, job.directory, job.cancel_event)
+            except Exception as e:
+                logger.error(f"Error in {job.kind} task for {job.directory}: {e}")
+                task['status'] = 'error'
+                task['error'] = str(e)
+                task['end_time'] = time.time()
+            finally:
+                with self.condition:
+                    if job.cancel_event.is_set() and task['status'] not in ('complete', 'error'):
+                        self._mark_cancelled(task)
+                    elif task['end_time'] is None:
+                        task['status'] = 'complete'
+                        task['end_time'] = time.time()
+                    self.busy_volumes.discard(job.volume)
+                    del self.running[job.task_id]
+                    # A cancelled job may already have been replaced by a new request
+                    if self.active.get((job.kind, job.directory)) is job:
+                        del self.active[(job.kind, job.directory)]
+                    # A freed volume may unblock jobs other workers are waiting on
+                    self.condition.notify_all()
+
+scan_scheduler = ScanScheduler(app.config['SCAN_WORKERS'])
+
 # Initialize the app by ensuring required folders and migrating favorites
 def initialize_app():
+    # Create the photo index before anything can write favorites into it
+    init_index_db()
+    
     # Ensure required folders exist
     ensure_trash_folder()
     ensure_favorites_folder()
+    cleanup_legacy_temp_folder()
+    load_profiling_settings()
+    
+    # Finish moves to the trash interrupted by a restart, then apply retention
+    resume_trash_moves()
+    schedule_trash_purge(force=True)
     
     # Migrate favorites from filesystem to JSON if needed
     migrate_favorites_to_json()
     
+    # Bring the photo index up to date with the monitored directories, and keep it so
+    schedule_index_refresh(get_monitored_directories())
+    start_index_refresh_timer()
+    
     logger.info("App initialization complete")
 
-# Call initialize on import
-initialize_app()
+# Call initialize on import, unless the importer only needs the app's code
+# (bench_memory.py sets SPEEDY_SKIP_INIT so no background work starts)
+if not os.environ.get('SPEEDY_SKIP_INIT'):
+    initialize_app()
 
 if __name__ == '__main__':
     import argparse
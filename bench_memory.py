@@ -0,0 +1,94 @@
+"""Memory benchmark for the cached directory image listings.
+
+Compares the old per-image dict representation with the DirectoryListing
+column representation used by get_directory_images, using tracemalloc.
+
+Usage:
+    python bench_memory.py [--images 200000] [--directories 200]
+"""
+import os
+import time
+import argparse
+import tracemalloc
+
+# Import the app without initializing it: no index walk, trash purge or
+# favorites migration running in the background of the measurements
+os.environ['SPEEDY_SKIP_INIT'] = '1'
+from app import DirectoryListing
+
+
+def synthetic_entries(num_images, num_directories):
+    """Yield (directory, name, created, modified, size) tuples resembling a photo library"""
+    base_time = time.time() - 5 * 365 * 86400
+    per_directory = max(1, num_images // num_directories)
+    for i in range(num_images):
+        directory = f"/Volumes/Pictures/LoojaPics/Olympus/Folder{i // per_directory:04d}"
+        name = f"P{1010000 + i:07d}.JPG"
+        created = base_time + i * 37.0
+        yield directory, name, created, created + 1.0, 4000000 + (i % 5000) * 1000
+
+
+def build_dict_records(entries):
+    """The original cache layout: one seven-key dict per image"""
+    cache = {}
+    for directory, name, created, modified, size in entries:
+        item_path = os.path.join(directory, name)
+        cache.setdefault(f"images:{directory}", (time.time(), []))[1].append({
+            'name': name,
+            'path': item_path,
+            'url': f"/image?path={item_path}",
+            'created': created,
+            'modified': modified,
+            'date_str': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))
+        })
+    return cache
+
+
+def build_listings(entries):
+    """The compact cache layout: one DirectoryListing per directory"""
+    cache = {}
+    for directory, name, created, modified, size in entries:
+        key = f"images:{directory}"
+        if key not in cache:
+            cache[key] = (time.time(), DirectoryListing(directory))
+        cache[key][1].append(name, created, modified, size)
+    return cache
+
+
+def measure(builder, num_images, num_directories):
+    """Return (retained bytes, peak bytes, seconds) for building a cache.
+
+    Entries are generated inside the traced region so that both layouts pay
+    for their own name strings, as they would when reading os.listdir().
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    cache = builder(synthetic_entries(num_images, num_directories))
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cache
+    return current, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speedy image cache memory benchmark')
+    parser.add_argument('--images', type=int, default=200000, help='Number of cached images')
+    parser.add_argument('--directories', type=int, default=200, help='Number of cached directories')
+    args = parser.parse_args()
+
+    print(f"{args.images} images in {args.directories} directories")
+
+    results = {}
+    for label, builder in (('dict records', build_dict_records), ('DirectoryListing', build_listings)):
+        current, peak, elapsed = measure(builder, args.images, args.directories)
+        results[label] = current
+        print(f"{label:>18}: {current / 1048576:8.1f} MiB retained, "
+              f"{peak / 1048576:8.1f} MiB peak, {elapsed:6.2f}s to build, "
+              f"{current / args.images:6.0f} bytes/image")
+
+    print(f"Reduction: {results['dict records'] / results['DirectoryListing']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
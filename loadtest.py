@@ -0,0 +1,392 @@
+"""Load-testing harness for Speedy.
+
+Reproduces the behaviour of a slow network volume locally by injecting a
+delay into the filesystem calls the app makes (os.listdir, os.scandir,
+os.stat, os.lstat and DirEntry.stat), and simulates users browsing the
+library over HTTP.
+
+Usage:
+    # Create a synthetic library to browse
+    python loadtest.py make-library /tmp/speedy-library --dirs 20 --images 200
+
+    # Run the app with 20-30ms of latency on every filesystem call
+    python loadtest.py serve --fs-latency-ms 20 --jitter-ms 10 --port 5001
+
+    # Simulate 20 users for 60 seconds against it
+    python loadtest.py run --url http://127.0.0.1:5001 --users 20 --duration 60
+
+    # Or start an in-process server with injected latency and load it in one go
+    python loadtest.py run --fs-latency-ms 20 --users 20 --duration 60
+
+Simulated users open a monitored directory, walk down the sidebar tree, list
+the images of a folder, page through its thumbnails and open a few images in
+the viewer. The report shows request count, errors, p50/p95/p99 latency and
+throughput per endpoint.
+"""
+import os
+import re
+import sys
+import json
+import math
+import html
+import time
+import random
+import argparse
+import threading
+import functools
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+# ---------------------------------------------------------------------------
+# Filesystem latency injection
+# ---------------------------------------------------------------------------
+
+class FilesystemLatency:
+    """Adds a delay to filesystem metadata calls made through the os module.
+
+    os.walk and the os.path helpers (isdir, isfile, exists) go through the
+    patched functions too. Entries returned by os.scandir are wrapped so that
+    DirEntry.stat() is delayed as well; is_dir()/is_file() stay free, as they
+    are served from the directory listing on most filesystems.
+    """
+
+    PATCHED_FUNCTIONS = ('listdir', 'scandir', 'stat', 'lstat')
+
+    def __init__(self, delay, jitter=0.0):
+        self.delay = delay
+        self.jitter = jitter
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.originals = {}
+
+    def sleep(self):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay + random.uniform(0, self.jitter))
+
+    def install(self):
+        for name in self.PATCHED_FUNCTIONS:
+            original = getattr(os, name)
+            self.originals[name] = original
+            wrapper = self._wrap_scandir(original) if name == 'scandir' else self._wrap(original)
+            setattr(os, name, wrapper)
+
+    def uninstall(self):
+        for name, original in self.originals.items():
+            setattr(os, name, original)
+        self.originals = {}
+
+    def _wrap(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.sleep()
+            return func(*args, **kwargs)
+        return wrapper
+
+    def _wrap_scandir(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.sleep()
+            return _SlowScandirIterator(func(*args, **kwargs), self)
+        return wrapper
+
+
+class _SlowScandirIterator:
+    """os.scandir iterator whose entries have a delayed stat()"""
+
+    def __init__(self, iterator, latency):
+        self.iterator = iterator
+        self.latency = latency
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return _SlowDirEntry(next(self.iterator), self.latency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.iterator.close()
+
+
+class _SlowDirEntry:
+    """Proxy for os.DirEntry that delays stat()"""
+
+    def __init__(self, entry, latency):
+        self._entry = entry
+        self._latency = latency
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def __fspath__(self):
+        return self._entry.path
+
+    def stat(self, *args, **kwargs):
+        self._latency.sleep()
+        return self._entry.stat(*args, **kwargs)
+
+
+# ---------------------------------------------------------------------------
+# Statistics
+# ---------------------------------------------------------------------------
+
+class EndpointStats:
+    """Thread-safe collection of request latencies per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, elapsed, ok):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, duration):
+        """Format a per-endpoint latency and throughput table"""
+        lines = [f"{'endpoint':<28}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}"
+                 f"{'p99 ms':>10}{'max ms':>10}{'req/s':>9}"]
+        with self.lock:
+            all_latencies = []
+            for endpoint in sorted(self.latencies):
+                latencies = sorted(self.latencies[endpoint])
+                all_latencies.extend(latencies)
+                lines.append(self._row(endpoint, latencies, self.errors.get(endpoint, 0), duration))
+            lines.append(self._row('TOTAL', sorted(all_latencies), sum(self.errors.values()), duration))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _row(label, latencies, errors, duration):
+        return (f"{label:<28}{len(latencies):>8}{errors:>8}"
+                f"{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 95) * 1000:>10.1f}"
+                f"{percentile(latencies, 99) * 1000:>10.1f}{(latencies[-1] if latencies else 0) * 1000:>10.1f}"
+                f"{len(latencies) / duration:>9.1f}")
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(pct / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+# ---------------------------------------------------------------------------
+# Simulated users
+# ---------------------------------------------------------------------------
+
+class BrowsingUser(threading.Thread):
+    """Simulates one person browsing the library until the deadline"""
+
+    def __init__(self, base_url, roots, stats, deadline, page_size, think_time, seed):
+        super().__init__(daemon=True)
+        self.base_url = base_url.rstrip('/')
+        self.roots = roots
+        self.stats = stats
+        self.deadline = deadline
+        self.page_size = page_size
+        self.think_time = think_time
+        self.rng = random.Random(seed)
+
+    def request(self, endpoint, params=None, json_body=None):
+        """Perform a request, record its latency and return the body (or None)"""
+        url = self.base_url + endpoint
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        data = None
+        headers = {}
+        if json_body is not None:
+            data = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers), timeout=60) as response:
+                body = response.read()
+            ok = True
+        except (urllib.error.URLError, OSError):
+            body = None
+            ok = False
+        self.stats.record(endpoint, time.perf_counter() - start, ok)
+        return body
+
+    def request_json(self, endpoint, params=None, json_body=None):
+        body = self.request(endpoint, params, json_body)
+        if body is None:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+    def think(self):
+        if self.think_time:
+            time.sleep(self.rng.uniform(0, self.think_time * 2))
+
+    def run(self):
+        while time.time() < self.deadline:
+            self.browse_once()
+
+    def browse_once(self):
+        # Open a monitored directory and walk a few levels down the sidebar
+        directory = self.rng.choice(self.roots)
+        node = self.request_json('/get_directory_structure', {'directory': directory, 'depth': 2})
+        for _ in range(self.rng.randint(0, 3)):
+            children = [child for child in (node or {}).get('children', []) if child.get('type') == 'directory']
+            if not children:
+                break
+            node = self.rng.choice(children)
+            directory = node['path']
+            if node.get('lazy') or not node.get('children'):
+                node = self.request_json('/get_directory_structure', {'directory': directory, 'depth': 2})
+            self.think()
+
+        # Open the folder and page through its thumbnails
+        images = self.request_json('/get_directory_images', {'directory': directory}) or []
+        pages = max(1, (len(images) + self.page_size - 1) // self.page_size)
+        for page in range(min(pages, self.rng.randint(1, 3))):
+            for image in images[page * self.page_size:(page + 1) * self.page_size]:
+                self.request('/image', {'path': image['path']})
+                if time.time() >= self.deadline:
+                    return
+            self.think()
+
+        # Open a few images in the viewer
+        for image in self.rng.sample(images, min(len(images), self.rng.randint(1, 5))):
+            self.request('/image', {'path': image['path']})
+            self.request_json('/check-favorited', json_body={'path': image['path']})
+            self.think()
+            if time.time() >= self.deadline:
+                return
+
+
+def discover_roots(base_url):
+    """Read the monitored directories from the sidebar of the main page"""
+    with urllib.request.urlopen(base_url.rstrip('/') + '/', timeout=60) as response:
+        page = response.read().decode('utf-8')
+    return [html.unescape(path) for path in re.findall(r'<li class="tree-item expanded" data-path="([^"]+)"', page)]
+
+
+# ---------------------------------------------------------------------------
+# Commands
+# ---------------------------------------------------------------------------
+
+def install_latency(args):
+    if args.fs_latency_ms or args.jitter_ms:
+        latency = FilesystemLatency(args.fs_latency_ms / 1000, args.jitter_ms / 1000)
+        latency.install()
+        print(f"Injecting {args.fs_latency_ms}ms (+0-{args.jitter_ms}ms) per filesystem call")
+        return latency
+    return None
+
+
+def command_serve(args):
+    install_latency(args)
+    from app import app
+    app.run(port=args.port, threaded=True)
+
+
+def command_run(args):
+    latency = None
+    server = None
+    base_url = args.url
+    if not base_url:
+        # In-process server; the latency applies to the app's startup work too
+        from werkzeug.serving import make_server
+        latency = install_latency(args)
+        from app import app
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        print(f"Started in-process server at {base_url}")
+
+    roots = args.root or discover_roots(base_url)
+    if not roots:
+        print("No monitored directories found; add one in the app or pass --root", file=sys.stderr)
+        return 1
+
+    stats = EndpointStats()
+    start = time.time()
+    deadline = start + args.duration
+    users = [BrowsingUser(base_url, roots, stats, deadline, args.page_size, args.think_time, args.seed + i)
+             for i in range(args.users)]
+    print(f"Simulating {args.users} users for {args.duration}s over {len(roots)} directories")
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    duration = time.time() - start
+
+    print(stats.report(duration))
+    if latency is not None:
+        print(f"Filesystem calls delayed: {latency.calls}")
+    if server is not None:
+        server.shutdown()
+    return 0
+
+
+def command_make_library(args):
+    from PIL import Image
+    rng = random.Random(args.seed)
+    count = 0
+    for i in range(args.dirs):
+        for j in range(args.subdirs + 1):
+            directory = os.path.join(args.directory, f"Folder{i:03d}")
+            if j:
+                directory = os.path.join(directory, f"Sub{j:02d}")
+            os.makedirs(directory, exist_ok=True)
+            for k in range(args.images):
+                color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+                Image.new('RGB', (160, 120), color).save(os.path.join(directory, f"P{i:03d}{j:02d}{k:04d}.JPG"))
+                count += 1
+    print(f"Created {count} images in {args.directory}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speedy load-testing harness')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_latency_arguments(subparser):
+        subparser.add_argument('--fs-latency-ms', type=float, default=0, help='Delay per filesystem call')
+        subparser.add_argument('--jitter-ms', type=float, default=0, help='Extra random delay per call (0 to N ms)')
+
+    serve = subparsers.add_parser('serve', help='Run the app with injected filesystem latency')
+    add_latency_arguments(serve)
+    serve.add_argument('--port', type=int, default=5001, help='Port to run the server on')
+    serve.set_defaults(func=command_serve)
+
+    run = subparsers.add_parser('run', help='Simulate users browsing the library')
+    add_latency_arguments(run)
+    run.add_argument('--url', help='Server to load; starts an in-process server if omitted')
+    run.add_argument('--users', type=int, default=10, help='Number of concurrent users')
+    run.add_argument('--duration', type=float, default=30, help='Test duration in seconds')
+    run.add_argument('--page-size', type=int, default=10, help='Thumbnails per gallery page')
+    run.add_argument('--think-time', type=float, default=0.2, help='Average pause between user actions in seconds')
+    run.add_argument('--root', action='append', help='Directory to browse (default: monitored directories)')
+    run.add_argument('--seed', type=int, default=1, help='Random seed for user behaviour')
+    run.set_defaults(func=command_run)
+
+    make_library = subparsers.add_parser('make-library', help='Create a synthetic photo library')
+    make_library.add_argument('directory', help='Where to create the library')
+    make_library.add_argument('--dirs', type=int, default=10, help='Number of top-level folders')
+    make_library.add_argument('--subdirs', type=int, default=2, help='Subfolders per folder')
+    make_library.add_argument('--images', type=int, default=100, help='Images per folder')
+    make_library.add_argument('--seed', type=int, default=1, help='Random seed for image colours')
+    make_library.set_defaults(func=command_make_library)
+
+    args = parser.parse_args()
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -97,36 +97,7 @@ function initDirectoryTree() {
             // Prevent the event from bubbling up to avoid triggering handleTreeItemClick twice
             event.stopPropagation();
             
-            const treeItem = this.closest('.tree-item');
-            const children = treeItem.querySelector('.tree-children');
-            
-            // Toggle expanded class on the tree item
-            treeItem.classList.toggle('expanded');
-            
-            // Toggle folder icon between open and closed
-            const folderIcon = this.querySelector('i.fas');
-            if (folderIcon) {
-                if (treeItem.classList.contains('expanded')) {
-                    folderIcon.classList.remove('fa-folder');
-                    folderIcon.classList.add('fa-folder-open');
-                } else {
-                    folderIcon.classList.remove('fa-folder-open');
-                    folderIcon.classList.add('fa-folder');
-                }
-            }
-            
-            // If this item has children and they're not loaded yet, load them
-            if (children) {
-                const path = treeItem.getAttribute('data-path');
-                // Check if this is a lazy-loaded directory that needs to be expanded
-                const isLazy = treeItem.getAttribute('data-lazy') === 'true';
-                
-                if (children.children.length === 0 || isLazy) {
-                    loadDirectoryContents(path, children);
-                    // Mark as no longer lazy-loaded
-                    treeItem.setAttribute('data-lazy', 'false');
-                }
-            }
+            toggleTreeItem(this);
         });
     });
     
@@ -155,6 +126,39 @@ function initDirectoryTree() {
     });
 }
 
+function toggleTreeItem(toggle) {
+    const treeItem = toggle.closest('.tree-item');
+    const children = treeItem.querySelector('.tree-children');
+    
+    // Toggle expanded class on the tree item
+    treeItem.classList.toggle('expanded');
+    
+    // Toggle folder icon between open and closed
+    const folderIcon = toggle.querySelector('i.fas');
+    if (folderIcon) {
+        if (treeItem.classList.contains('expanded')) {
+            folderIcon.classList.remove('fa-folder');
+            folderIcon.classList.add('fa-folder-open');
+        } else {
+            folderIcon.classList.remove('fa-folder-open');
+            folderIcon.classList.add('fa-folder');
+        }
+    }
+    
+    // If this item has children and they're not loaded yet, load them
+    if (children) {
+        const path = treeItem.getAttribute('data-path');
+        // Check if this is a lazy-loaded directory that needs to be expanded
+        const isLazy = treeItem.getAttribute('data-lazy') === 'true';
+        
+        if (children.children.length === 0 || isLazy) {
+            loadDirectoryContents(path, children);
+            // Mark as no longer lazy-loaded
+            treeItem.setAttribute('data-lazy', 'false');
+        }
+    }
+}
+
 function handleTreeItemClick(event) {
     // Prevent the default action
     event.preventDefault();
@@ -188,12 +192,18 @@ function loadDirectoryContents(path, container) {
     // Show loading indicator
     container.innerHTML = '<li class="loading">Loading...</li>';
     
-    // Fetch directory structure from server
-    fetch(`/get_directory_structure?directory=${encodeURIComponent(path)}`)
+    // Fetch directory structure from server, two levels at once so the next
+    // expansion is served from the cache
+    fetch(`/get_directory_structure?directory=${encodeURIComponent(path)}&depth=2`)
         .then(response => response.json())
         .then(data => {
-            // Cache the result
+            // Cache the result and any subdirectories that came with it
             directoryCache[path] = data;
+            (data.children || []).forEach(child => {
+                if (child.type === 'directory' && !child.lazy) {
+                    directoryCache[child.path] = child;
+                }
+            });
             
             // Render the directory contents
             renderDirectoryContents(data, container);
@@ -237,7 +247,11 @@ function renderDirectoryContents(data, container) {
             const toggle = document.createElement('span');
             toggle.className = 'tree-toggle';
             toggle.innerHTML = `<i class="fas fa-folder"></i> ${child.name}`;
+            if (child.image_count) {
+                toggle.innerHTML += ` <span class="tree-count">${child.image_count}</span>`;
+            }
             toggle.addEventListener('click', handleTreeItemClick);
+            toggle.addEventListener('click', () => toggleTreeItem(toggle));
             
             // Add toggle to header
             header.appendChild(toggle);
@@ -261,6 +275,37 @@ function renderDirectoryContents(data, container) {
     }
 }
 
+// Expand a column-oriented listing from /get_directory_images?format=compact
+function expandCompactListing(listing) {
+    const prefix = listing.directory.endsWith(listing.sep) ? listing.directory : listing.directory + listing.sep;
+    
+    // Kinds other than plain images are sent as lists of indexes
+    const kinds = {};
+    Object.entries(listing.media || {}).forEach(([kind, indexes]) => {
+        indexes.forEach(i => { kinds[i] = kind; });
+    });
+    
+    return listing.names.map((name, i) => {
+        const path = prefix + name;
+        const kind = kinds[i] || 'image';
+        const fileUrl = `/image?path=${encodeURIComponent(path)}`;
+        const previewUrl = `/rendition?path=${encodeURIComponent(path)}`;
+        // RAW and HEIC files are shown through their previews; videos play from the file
+        const url = (kind === 'raw' || kind === 'heic') ? previewUrl : fileUrl;
+        return {
+            name: name,
+            path: path,
+            kind: kind,
+            url: url,
+            // Grid tiles of RAW, HEIC and video files use small cached thumbnails
+            thumbnail_url: kind === 'image' ? url : `${previewUrl}&size=thumb`,
+            created: listing.created[i],
+            modified: listing.modified[i],
+            size: listing.sizes[i]
+        };
+    });
+}
+
 function loadDirectoryImages(path) {
     const gallery = document.getElementById('image-gallery');
     
@@ -278,9 +323,10 @@ function loadDirectoryImages(path) {
     }
     
     // Fetch images for the directory
-    fetch(`/get_directory_images?directory=${encodeURIComponent(path)}`)
+    fetch(`/get_directory_images?directory=${encodeURIComponent(path)}&format=compact`)
         .then(response => response.json())
-        .then(images => {
+        .then(listing => {
+            const images = expandCompactListing(listing);
             console.log(`Received ${images.length} images from server for ${path}`);
             
             // Debug: Log all received images
@@ -606,9 +652,25 @@ function hideProgressDialog() {
     if (scanInterval) {
         clearInterval(scanInterval);
         scanInterval = null;
+        
+        // The scan is still queued or running, so cancel it on the server
+        if (scanTaskId) {
+            cancelScan(scanTaskId);
+        }
     }
 }
 
+function cancelScan(taskId) {
+    fetch(`/scan_cancel/${taskId}`, { method: 'POST' })
+        .then(response => response.json())
+        .then(data => {
+            console.log(`Scan ${taskId} cancel requested: ${data.status}`);
+        })
+        .catch(error => {
+            console.error('Error cancelling scan:', error);
+        });
+}
+
 function updateProgressDialog(data) {
     const progressBar = document.getElementById('progress-bar');
     const progressStatus = document.getElementById('progress-status');
@@ -620,8 +682,12 @@ function updateProgressDialog(data) {
     progressBar.style.width = `${data.progress}%`;
     
     // Update status text based on scan status
-    if (data.status === 'scanning') {
+    if (data.status === 'queued') {
+        progressStatus.textContent = 'Waiting for other scans on this volume...';
+    } else if (data.status === 'scanning') {
         progressStatus.textContent = `Scanning directory... ${data.progress}%`;
+    } else if (data.status === 'cancelled') {
+        progressStatus.textContent = 'Scan cancelled';
     } else if (data.status === 'complete') {
         progressStatus.textContent = 'Scan complete!';
     } else if (data.status === 'error') {
@@ -742,7 +808,7 @@ function pollScanStatus(taskId) {
             updateProgressDialog(data);
             
             // If scan is complete or errored, stop polling
-            if (data.status === 'complete' || data.status === 'error') {
+            if (data.status === 'complete' || data.status === 'error' || data.status === 'cancelled') {
                 clearInterval(scanInterval);
                 scanInterval = null;
             }
@@ -1222,7 +1288,7 @@ let currentViewerIndex = -1;
 let isNavigating = false; // Flag to prevent multiple rapid navigation calls
 let showImageInfo = false; // Flag to track if image info is visible
 let currentRotation = 0; // Track current rotation angle (0, 90, 180, 270)
-let tempRotatedImagePath = null; // Track path to temporary rotated image
+let rotationPreviewUrl = null; // Preview of the pending (unsaved) rotation
 
 function initImageViewer() {
     // Set up image viewer event listeners
@@ -1249,6 +1315,17 @@ function initImageViewer() {
 }
 
 // Function to close the image viewer
+// Stop and hide the viewer's video element
+function stopViewerVideo() {
+    const videoElement = document.getElementById('viewer-video');
+    if (!videoElement) return;
+    videoElement.pause();
+    videoElement.removeAttribute('src');
+    videoElement.removeAttribute('poster');
+    videoElement.load();
+    videoElement.style.display = 'none';
+}
+
 function closeImageViewer() {
     console.log('Closing image viewer');
     
@@ -1258,11 +1335,13 @@ function closeImageViewer() {
         modal.style.display = 'none';
     }
     
+    // Drop any rotation that was not saved
+    discardPendingRotation();
+    stopViewerVideo();
+    
     // Reset the viewer state
     imageViewerOpen = false;
     currentViewerIndex = -1;
-    currentRotation = 0;
-    tempRotatedImagePath = null;
     
     // Re-enable scrolling on the body
     document.body.style.overflow = 'auto';
@@ -1444,7 +1523,7 @@ function rotateImage(direction) {
     }
     
     const currentImage = currentImages[currentViewerIndex];
-    const imagePath = tempRotatedImagePath || currentImage.path;
+    const imagePath = currentImage.path;
     const imageElement = document.getElementById('viewer-image');
     
     if (!imageElement) {
@@ -1452,6 +1531,12 @@ function rotateImage(direction) {
         return;
     }
     
+    // Only plain images can be rotated; RAW, HEIC and video files are left as they are
+    if (currentImage.kind && currentImage.kind !== 'image') {
+        console.log(`Rotation is not supported for ${currentImage.kind} files`);
+        return;
+    }
+    
     // Show loading indicator
     imageElement.style.opacity = '0.5';
     
@@ -1469,28 +1554,26 @@ function rotateImage(direction) {
     .then(response => response.json())
     .then(data => {
         if (data.success) {
-            // Update the rotation angle
-            if (direction === 'clockwise') {
-                currentRotation = (currentRotation + 90) % 360;
+            // The server composes all rotation steps into one pending angle
+            currentRotation = data.rotation;
+            rotationPreviewUrl = data.preview_url;
+            
+            // Show the rotated preview, or the original once back at 0 degrees
+            if (rotationPreviewUrl) {
+                // Add a timestamp to prevent browser caching
+                const timestamp = new Date().getTime();
+                imageElement.src = `${rotationPreviewUrl}&t=${timestamp}`;
             } else {
-                currentRotation = (currentRotation - 90 + 360) % 360;
+                imageElement.src = `/image?path=${encodeURIComponent(imagePath)}`;
             }
             
-            // Store the temporary path
-            tempRotatedImagePath = data.temp_path;
-            
-            // Update the image source with the rotated image
-            // Add a timestamp to prevent browser caching
-            const timestamp = new Date().getTime();
-            imageElement.src = `/image?path=${encodeURIComponent(data.temp_path)}&t=${timestamp}`;
-            
             // Reset the transform since we're loading a pre-rotated image
             imageElement.style.transform = 'rotate(0deg)';
             
-            // Show save button if not already visible
+            // Only offer saving while there is a rotation to apply
             const saveButton = document.getElementById('save-rotation');
             if (saveButton) {
-                saveButton.style.display = 'flex';
+                saveButton.style.display = currentRotation ? 'flex' : 'none';
             }
             
             console.log(`Image rotated ${direction}, current angle: ${currentRotation}°`);
@@ -1509,9 +1592,24 @@ function rotateImage(direction) {
     });
 }
 
+// Function to forget the current image's unsaved rotation and reset rotation state
+function discardPendingRotation() {
+    if (currentRotation && currentViewerIndex >= 0 && currentViewerIndex < currentImages.length) {
+        fetch('/discard-rotation', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ path: currentImages[currentViewerIndex].path })
+        }).catch(error => console.error('Error discarding rotation:', error));
+    }
+    currentRotation = 0;
+    rotationPreviewUrl = null;
+}
+
 // Function to save the rotated image
 function saveRotatedImage() {
-    if (!tempRotatedImagePath) {
+    if (!currentRotation) {
         console.log('No rotated image to save');
         return;
     }
@@ -1540,8 +1638,8 @@ function saveRotatedImage() {
             'Content-Type': 'application/json'
         },
         body: JSON.stringify({
-            temp_path: tempRotatedImagePath,
-            original_path: originalPath
+            original_path: originalPath,
+            rotation: currentRotation
         })
     })
     .then(response => response.json())
@@ -1549,7 +1647,7 @@ function saveRotatedImage() {
         if (data.success) {
             // Reset rotation state
             currentRotation = 0;
-            tempRotatedImagePath = null;
+            rotationPreviewUrl = null;
             
             // Hide save button
             const saveButton = document.getElementById('save-rotation');
@@ -1575,14 +1673,14 @@ function saveRotatedImage() {
         // Check if the image was actually saved despite the error
         console.error('Error in save request:', error);
         
-        // If tempRotatedImagePath is no longer valid, it might mean the save was successful
+        // If there is no pending rotation anymore, it might mean the save was successful
         // but there was an error in the response handling
-        if (!tempRotatedImagePath || !originalPath) {
+        if (!currentRotation || !originalPath) {
             console.log('Image appears to have been saved despite the error');
             
             // Reset rotation state
             currentRotation = 0;
-            tempRotatedImagePath = null;
+            rotationPreviewUrl = null;
             
             // Hide save button
             const saveButton = document.getElementById('save-rotation');
@@ -1644,20 +1742,30 @@ function updateImageViewer(index) {
         return;
     }
 
+    // Drop any unsaved rotation of the previous image
+    discardPendingRotation();
+    
     currentViewerIndex = index;
     const currentImage = currentImages[index];
     const imagePath = currentImage.path;
     
-    // Reset rotation state for new image
-    currentRotation = 0;
-    tempRotatedImagePath = null;
-    
-    // Update the image source
+    // Update the image source; videos play in the video element instead
+    const isVideo = currentImage.kind === 'video';
     const imageElement = document.getElementById('viewer-image');
     if (imageElement) {
-        imageElement.src = `/image?path=${encodeURIComponent(imagePath)}`;
+        imageElement.src = isVideo ? '' : (currentImage.url || `/image?path=${encodeURIComponent(imagePath)}`);
         imageElement.alt = currentImage.name;
         imageElement.style.transform = 'rotate(0deg)';
+        imageElement.style.display = isVideo ? 'none' : '';
+    }
+    const videoElement = document.getElementById('viewer-video');
+    if (videoElement) {
+        stopViewerVideo();
+        if (isVideo) {
+            videoElement.poster = currentImage.thumbnail_url;
+            videoElement.src = currentImage.url;
+            videoElement.style.display = '';
+        }
     }
 
     // Update image info
@@ -1822,10 +1930,23 @@ function renderGalleryForPage(page, selectedIndex = -1) {
         
         // Create image element
         const img = document.createElement('img');
-        img.src = image.url;
+        img.src = image.thumbnail_url || image.url;
         img.alt = image.name;
         img.loading = 'lazy'; // Use lazy loading for better performance
         
+        if (image.kind === 'video') {
+            div.classList.add('video-item');
+            const badge = document.createElement('i');
+            badge.className = 'fas fa-play-circle media-badge';
+            div.appendChild(badge);
+        }
+        if (image.kind && image.kind !== 'image') {
+            // No preview could be extracted (e.g. no poster extractor for videos)
+            img.addEventListener('error', function() {
+                div.classList.add('no-preview');
+            });
+        }
+        
         // Add click event to select the image (not open viewer)
         img.addEventListener('click', function() {
             // Get the index from the parent div